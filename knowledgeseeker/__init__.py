@@ -9,18 +9,41 @@ def create_app(test_config=None):
     app.config.from_pyfile('config.py')
     app.config['DEV'] = 'FLASK_ENV' in environ and environ['FLASK_ENV'] == 'development'
     for key in ['LIBRARY', 'PIL_FONT', 'FF_FONT_DIR']:
-        app.config[key] = Path(app.instance_path)/app.config[key]
+        if key in app.config:
+            app.config[key] = Path(app.instance_path)/app.config[key]
+    if app.config.get('LIBRARIES'):
+        app.config['LIBRARIES'] = {
+            name: Path(app.instance_path)/path
+            for name, path in app.config['LIBRARIES'].items() }
 
     try:
         makedirs(app.instance_path)
     except OSError:
         pass
 
+    # With multiple libraries, every library's pages live under its own
+    # prefix and the root serves the library list and cross-library search.
+    if app.config.get('LIBRARIES'):
+        import knowledgeseeker.shards as shards
+        shards.init_app(app)
+        url_prefix = '/<shard>'
+    else:
+        url_prefix = None
+
+    import knowledgeseeker.profiling as profiling
+    profiling.init_app(app)
+
+    import knowledgeseeker.admission as admission
+    admission.init_app(app)
+
     import knowledgeseeker.clips as clips
-    app.register_blueprint(clips.bp)
+    app.register_blueprint(clips.bp, url_prefix=url_prefix)
 
     import knowledgeseeker.webui as webui
-    app.register_blueprint(webui.bp)
+    app.register_blueprint(webui.bp, url_prefix=url_prefix)
+
+    import knowledgeseeker.lookup as lookup
+    app.register_blueprint(lookup.bp, url_prefix=url_prefix)
 
     import knowledgeseeker.library as library
     library.init_app(app)
@@ -28,5 +51,14 @@ def create_app(test_config=None):
     import knowledgeseeker.database as database
     database.init_app(app)
 
+    import knowledgeseeker.export as export
+    export.init_app(app)
+
+    import knowledgeseeker.captions as captions
+    captions.init_app(app)
+
+    import knowledgeseeker.bench as bench
+    bench.init_app(app)
+
     return app
 
@@ -0,0 +1,198 @@
+import math
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import flask
+
+
+# Relative cost of each route, in tokens. Clip costs are per 10 seconds of
+# clip, and requests costing at most FREE_COST are never limited.
+ROUTE_COSTS = { 'clips.snapshot_tiny': 0.1,
+                'clips.snapshot': 1,
+                'clips.gif': 20,
+                'clips.gif_with_subtitles': 30,
+                'clips.webm': 40,
+                'clips.webm_with_subtitles': 60,
+                'clips.mp4': 5,
+                'lookup.lookup': 5,
+                'webui.search': 1,
+                'shards.search': 1 }
+CAPTION_COST = 4
+# Rendering a frame that wasn't stored costs at least as much as captioning
+# one that was.
+ONDEMAND_COST = 4
+EXACT_MP4_COST = 15
+# Sources that can't be stream copied into an MP4 are re-encoded in full, on
+# top of the route's cost.
+REENCODE_MP4_COST = 20
+CLIP_UNIT_MS = 10000
+FREE_COST = 1
+
+# Every client may spend CLIENT_RATE tokens per second, saving up to
+# CLIENT_BURST; all clients together may spend GLOBAL_RATE, saving up to
+# GLOBAL_BURST.
+CLIENT_RATE = 1.0
+CLIENT_BURST = 120
+GLOBAL_RATE = 20.0
+GLOBAL_BURST = 600
+GLOBAL_KEY = '*'
+# In-process buckets are swept this often; only buckets that have refilled
+# completely are forgotten, since a missing bucket counts as full.
+PRUNE_SECS = 600
+# Shared buckets are pruned by a random request now and then.
+PRUNE_CHANCE = 0.001
+
+
+class MemoryBuckets(object):
+    __slots__ = ('_lock', '_buckets', '_pruned')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._pruned = time.time()
+
+    def take(self, keys, cost, limits, now):
+        with self._lock:
+            if now - self._pruned > PRUNE_SECS:
+                rate, burst = prune_limit(limits)
+                self._buckets = { key: bucket
+                                  for key, bucket in self._buckets.items()
+                                  if refill(bucket, rate, burst, now) < burst }
+                self._pruned = now
+            levels = [refill(self._buckets.get(key), rate, burst, now)
+                      for key, (rate, burst) in zip(keys, limits)]
+            retry_after = shortfall(levels, cost, limits)
+            if retry_after == 0:
+                for key, level in zip(keys, levels):
+                    self._buckets[key] = (level - cost, now)
+            return retry_after
+
+
+class FileBuckets(object):
+    # Buckets shared by every worker process through an SQLite file.
+    __slots__ = ('_path', '_local')
+
+    def __init__(self, path):
+        self._path = str(path)
+        self._local = threading.local()
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                   '    key     TEXT PRIMARY KEY, '
+                   '    tokens  REAL NOT NULL, '
+                   '    updated REAL NOT NULL)')
+        db.commit()
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self._path, timeout=5,
+                                                  isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+        return db
+
+    def take(self, keys, cost, limits, now):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for key, (rate, burst) in zip(keys, limits):
+                row = db.execute('SELECT tokens, updated FROM bucket WHERE key=?',
+                                 (key,)).fetchone()
+                levels.append(refill(row, rate, burst, now))
+            retry_after = shortfall(levels, cost, limits)
+            if retry_after == 0:
+                db.executemany(
+                    'INSERT OR REPLACE INTO bucket (key, tokens, updated) '
+                    '       VALUES (?, ?, ?)',
+                    [(key, level - cost, now) for key, level in zip(keys, levels)])
+            if random.random() < PRUNE_CHANCE:
+                rate, burst = prune_limit(limits)
+                db.execute('DELETE FROM bucket WHERE tokens + (?-updated)*? >= ?',
+                           (now, rate, burst))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+def refill(bucket, rate, burst, now):
+    if bucket is None:
+        return burst
+    tokens, updated = bucket
+    return min(burst, tokens + max(0.0, now - updated)*rate)
+
+
+def prune_limit(limits):
+    # The slowest rate and largest burst of any bucket: a bucket that would
+    # be full under these is certainly full under its own limits.
+    return (min(rate for rate, burst in limits),
+            max(burst for rate, burst in limits))
+
+
+def shortfall(levels, cost, limits):
+    # Seconds until every bucket holds cost tokens, or 0 if they already do.
+    return max(max(0.0, (min(cost, burst) - level)/rate)
+               for level, (rate, burst) in zip(levels, limits))
+
+
+def request_cost():
+    endpoint = flask.request.endpoint
+    cost = ROUTE_COSTS.get(endpoint, 0)
+    args = flask.request.args
+    if endpoint == 'clips.snapshot' and ('topb64' in args or 'btmb64' in args):
+        cost = CAPTION_COST
+    elif endpoint == 'clips.mp4' and args.get('exact', '0') not in ('', '0'):
+        cost = EXACT_MP4_COST
+    return clip_cost(cost)
+
+
+def clip_cost(cost):
+    # Scales a per-clip cost by the length of the requested clip, if any.
+    view_args = flask.request.view_args or {}
+    if 'ms1' in view_args and 'ms2' in view_args:
+        cost *= max(1, view_args['ms2'] - view_args['ms1'])/CLIP_UNIT_MS
+    return cost
+
+
+def charge(cost):
+    # Takes cost tokens for work a view finds it has to do beyond what its
+    # route was charged for, like rendering a frame or retrying a clip.
+    take = flask.current_app.extensions.get('admission')
+    if take is not None:
+        take(cost)
+
+
+def init_app(app):
+    if not app.config.get('ADMISSION_CONTROL', False):
+        return
+    state = app.config.get('ADMISSION_STATE')
+    if state is not None:
+        buckets = FileBuckets(Path(app.instance_path)/state)
+    else:
+        buckets = MemoryBuckets()
+
+    def take(cost):
+        limits = [(app.config.get('ADMISSION_CLIENT_RATE', CLIENT_RATE),
+                   app.config.get('ADMISSION_CLIENT_BURST', CLIENT_BURST)),
+                  (app.config.get('ADMISSION_GLOBAL_RATE', GLOBAL_RATE),
+                   app.config.get('ADMISSION_GLOBAL_BURST', GLOBAL_BURST))]
+        keys = ['client:%s' % flask.request.remote_addr, GLOBAL_KEY]
+        retry_after = buckets.take(keys, cost, limits, time.time())
+        if retry_after > 0:
+            response = flask.make_response('too many expensive requests', 429)
+            response.headers.set('Retry-After', str(math.ceil(retry_after)))
+            flask.abort(response)
+    app.extensions['admission'] = take
+
+    @app.before_request
+    def admit():
+        cost = request_cost()
+        if cost <= app.config.get('ADMISSION_FREE_COST', FREE_COST):
+            return None
+        take(cost)
+        return None
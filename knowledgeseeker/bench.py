@@ -0,0 +1,162 @@
+import json
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+import click
+from flask.cli import with_appcontext
+
+import knowledgeseeker.images as images
+from knowledgeseeker.database import connect, is_read, shard_names
+from knowledgeseeker.lookup import find_frames, MAX_DISTANCE
+
+
+def init_app(app):
+    app.cli.add_command(bench_codecs_command)
+    app.cli.add_command(bench_lookup_command)
+    app.cli.add_command(bench_startup_command)
+
+
+def shard_option(f):
+    return click.option('--library', 'shard', default=None,
+                        help='Library to sample (with LIBRARIES configured).')(f)
+
+
+@click.command('bench-codecs')
+@click.option('--samples', default=50, show_default=True,
+              help='Number of stored snapshots to sample.')
+@click.option('--quality', 'qualities', multiple=True, type=int,
+              default=[60, 75, 85, 95], show_default=True,
+              help='Quality settings to try for lossy formats (repeatable).')
+@shard_option
+@with_appcontext
+def bench_codecs_command(samples, qualities, shard):
+    """Compare storage size, encode and decode time of snapshot codecs."""
+    if shard is None:
+        read = [name for name in shard_names() if is_read(name)]
+        if not read:
+            raise click.ClickException('no library has been read yet')
+        shard = read[0]
+    elif not is_read(shard):
+        raise click.ClickException('library not read yet: %s' % shard)
+    db = connect(shard)
+    cur = db.cursor()
+    cur.execute('SELECT image FROM frame ORDER BY RANDOM() LIMIT :n',
+                { 'n': samples })
+    sources = [images.decode(row['image']).convert('RGB')
+               for row in cur.fetchall()]
+    db.close()
+    if not sources:
+        raise click.ClickException('no snapshots to sample')
+
+    print('%-6s %7s %12s %12s %12s'
+          % ('format', 'quality', 'avg bytes', 'encode ms', 'decode ms'))
+    for fmt in images.available_formats():
+        for quality in ([None] if fmt in images.LOSSLESS_FORMATS else qualities):
+            size = encode_secs = decode_secs = 0.0
+            for source in sources:
+                start = time.perf_counter()
+                data = images.encode(source, fmt, quality=quality)
+                encode_secs += time.perf_counter() - start
+                start = time.perf_counter()
+                images.decode(data)
+                decode_secs += time.perf_counter() - start
+                size += len(data)
+            n = len(sources)
+            print('%-6s %7s %12d %12.2f %12.2f'
+                  % (fmt, quality if quality is not None else '-', size/n,
+                     encode_secs/n*1000, decode_secs/n*1000))
+
+
+@click.command('bench-lookup')
+@click.option('--frames', default=1000000, show_default=True,
+              help='Number of synthetic frames to index.')
+@click.option('--queries', default=100, show_default=True,
+              help='Number of lookups to time.')
+@click.option('--distance', default=MAX_DISTANCE, show_default=True,
+              help='Maximum Hamming distance of a match.')
+@click.option('--seed', default=0, show_default=True)
+def bench_lookup_command(frames, queries, distance, seed):
+    """Time reverse image lookups against a synthetic hash index."""
+    rng = random.Random(seed)
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    cur = db.cursor()
+    cur.execute('CREATE TABLE frame (id INTEGER PRIMARY KEY, phash INTEGER NOT NULL)')
+    cur.execute('CREATE TABLE frame_hash ('
+                '    part INTEGER NOT NULL, chunk INTEGER NOT NULL, '
+                '    frame_id INTEGER NOT NULL, '
+                '    PRIMARY KEY (part, chunk, frame_id)) WITHOUT ROWID')
+
+    def signed(value):
+        return value - (1 << 64) if value >= 1 << 63 else value
+    hashes = [signed(rng.getrandbits(64)) for _ in range(frames)]
+    start = time.perf_counter()
+    cur.executemany('INSERT INTO frame (id, phash) VALUES (?, ?)',
+                    enumerate(hashes))
+    cur.executemany('INSERT INTO frame_hash (part, chunk, frame_id) VALUES (?, ?, ?)',
+                    ((part, chunk, frame_id)
+                     for frame_id, phash in enumerate(hashes)
+                     for part, chunk in enumerate(images.hash_chunks(phash))))
+    db.commit()
+    print('indexed %d frames in %.1f s' % (frames, time.perf_counter() - start))
+
+    # Query with stored hashes that have a few random bits flipped, as a
+    # re-encoded or rescaled screenshot would.
+    index_secs = scan_secs = 0.0
+    found = 0
+    for _ in range(queries):
+        target = rng.randrange(frames)
+        query = hashes[target]
+        for bit in rng.sample(range(64), rng.randint(0, distance)):
+            query = signed((query & images.HASH_MASK) ^ (1 << bit))
+
+        start = time.perf_counter()
+        matches = find_frames(cur, query, distance, 10)
+        index_secs += time.perf_counter() - start
+        found += any(frame_id == target for frame_id, _ in matches)
+
+        start = time.perf_counter()
+        sorted((images.hamming(query, phash), frame_id)
+               for frame_id, phash in enumerate(hashes)
+               if images.hamming(query, phash) <= distance)
+        scan_secs += time.perf_counter() - start
+    db.close()
+
+    print('multi-index lookup: %.2f ms/query, recall %d/%d'
+          % (index_secs/queries*1000, found, queries))
+    print('linear scan:        %.2f ms/query' % (scan_secs/queries*1000))
+
+
+# Run in a fresh interpreter, as a server worker would start.
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+from knowledgeseeker import create_app
+app = create_app()
+with app.test_client() as client:
+    client.get('/about')
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy_modules': sorted(m for m in ('cv2', 'numpy') if m in sys.modules) }))
+"""
+
+
+@click.command('bench-startup')
+@click.option('--runs', default=5, show_default=True)
+def bench_startup_command(runs):
+    """Measure a serving worker's startup time and resident memory."""
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT],
+                             check=True, stdout=subprocess.PIPE).stdout
+        results.append(json.loads(out.decode('utf-8').splitlines()[-1]))
+    seconds = sorted(result['seconds'] for result in results)
+    print('startup: %.0f ms median, %.0f ms min'
+          % (seconds[len(seconds)//2]*1000, seconds[0]*1000))
+    print('max RSS: %.1f MB' % (max(result['maxrss_kb'] for result in results)/1024))
+    print('heavy modules loaded: %s'
+          % (', '.join(results[0]['heavy_modules']) or 'none'))
@@ -0,0 +1,182 @@
+import hashlib
+import textwrap as tw
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+import knowledgeseeker.images as images
+from knowledgeseeker.database import connect, is_read, shard_names
+from knowledgeseeker.utils import strip_html
+
+
+TEXT_VMARGIN = 0.1
+TEXT_SPACING = 4
+CAPTION_FORMAT = 'jpeg'
+CAPTION_QUALITY = 85
+CAPTION_WORKERS = 4
+CHUNK_SIZE = 16
+BATCH_SIZE = 512
+
+# Worker-local drawing settings, set once per process by _init_worker().
+_font = None
+_max_width = None
+_quality = None
+
+
+def init_app(app):
+    app.cli.add_command(render_captions_command)
+
+
+def caption_text(content):
+    # The text a "JPEG+Sub" link asks for: the stripped subtitle, passed
+    # through base64 as UTF-8 and read back as ASCII by clips.snapshot.
+    return strip_html(content).encode('utf-8').decode('ascii', 'ignore')
+
+
+def caption_hash(top_text, bottom_text):
+    return hashlib.sha1(
+        ('%s\0%s' % (top_text, bottom_text)).encode('ascii')).digest()
+
+
+def load_font(font_path, font_size):
+    if font_path is None:
+        return None
+    return ImageFont.truetype(font=str(font_path), size=font_size)
+
+
+def draw(image, top_text, bottom_text, font=None, max_width=30):
+    max_length = max_width*2
+    canvas = ImageDraw.Draw(image)
+    def wrap(t):
+        return '\n'.join(tw.wrap(t, width=max_width))
+
+    if top_text != '':
+        text = wrap(top_text[:max_length])
+        size = text_size(canvas, text, font)
+        pos = (round(image.width/2 - size[0]/2), round(TEXT_VMARGIN*image.height))
+        draw_text(image, canvas, pos, text, font)
+
+    if bottom_text != '':
+        text = wrap(bottom_text[:max_length])
+        size = text_size(canvas, text, font)
+        pos = (round(image.width/2 - size[0]/2),
+               image.height - round(TEXT_VMARGIN*image.height) - size[1])
+        draw_text(image, canvas, pos, text, font)
+
+
+def draw_text(image, canvas, pos, text, font):
+    blurred = Image.new('RGBA', image.size)
+    blurredDraw = ImageDraw.Draw(blurred)
+    blurredDraw.multiline_text(pos, text, fill='black', font=font,
+                               spacing=TEXT_SPACING, align='center')
+    blurred = blurred.filter(ImageFilter.BoxBlur(7))
+
+    # Paste soft text onto background
+    image.paste(blurred,blurred)
+
+    canvas.multiline_text(pos, text, font=font,
+                          spacing=TEXT_SPACING, align='center')
+
+
+def text_size(canvas, text, font):
+    # multiline_textsize was removed in Pillow 10.
+    if hasattr(canvas, 'multiline_textbbox'):
+        left, top, right, bottom = canvas.multiline_textbbox(
+            (0, 0), text, font=font, spacing=TEXT_SPACING)
+        return right, bottom
+    return canvas.multiline_textsize(text, font=font, spacing=TEXT_SPACING)
+
+
+@click.command('render-captions')
+@click.option('--library', 'names', multiple=True,
+              help='Only render the named library (repeatable).')
+@click.option('--workers', default=CAPTION_WORKERS, show_default=True,
+              help='Number of rendering processes.')
+@with_appcontext
+def render_captions_command(names, workers):
+    """Pre-render every subtitle line captioned onto its snapshot."""
+    shards = shard_names()
+    for name in names:
+        if name not in shards:
+            raise click.BadParameter('unknown library: %s' % name,
+                                     param_hint='--library')
+    for shard in (names or shards):
+        if not is_read(shard):
+            print('Skipping %s: not read yet' % (shard or 'library'))
+            continue
+        if shard is not None:
+            print('Rendering captions for %s' % shard)
+        render_captions(shard, workers=workers)
+
+
+def render_captions(shard=None, workers=CAPTION_WORKERS):
+    db = connect(shard)
+    cur = db.cursor()
+    cur.execute('DELETE FROM caption')
+    cur.execute(
+        'SELECT DISTINCT subtitle.episode_id, subtitle.snapshot_ms, '
+        '                subtitle.content, snapshot.frame_id '
+        '           FROM subtitle '
+        '     INNER JOIN snapshot ON snapshot.episode_id = subtitle.episode_id '
+        '                            AND snapshot.ms = subtitle.snapshot_ms '
+        '          WHERE subtitle.snapshot_ms IS NOT NULL')
+    jobs = {}
+    for row in cur.fetchall():
+        text = caption_text(row['content'])
+        if text == '':
+            continue
+        key = (row['episode_id'], row['snapshot_ms'], caption_hash('', text))
+        jobs[key] = (row['frame_id'], text)
+
+    config = current_app.config
+    initargs = (config.get('PIL_FONT', None), config.get('PIL_FONT_SIZE'),
+                config.get('PIL_MAXWIDTH'),
+                config.get('SERVE_QUALITY', CAPTION_QUALITY))
+    # Frames are read a batch at a time to bound memory, since the pool
+    # would otherwise take every job at once.
+    keys = list(jobs.keys())
+    fcur = db.cursor()
+    icur = db.cursor()
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i + BATCH_SIZE]
+            sources = []
+            for key in batch:
+                frame_id, text = jobs[key]
+                fcur.execute('SELECT image FROM frame WHERE id=:frame_id',
+                             { 'frame_id': frame_id })
+                sources.append((fcur.fetchone()['image'], text))
+            for key, data in zip(batch, executor.map(_render, sources,
+                                                     chunksize=CHUNK_SIZE)):
+                episode_id, ms, text_hash = key
+                icur.execute(
+                    'INSERT INTO caption (episode_id, ms, text_hash, '
+                    '                     image, format) '
+                    '       VALUES (:episode_id, :ms, :text_hash, '
+                    '               :image, :format)',
+                    { 'episode_id': episode_id, 'ms': ms,
+                      'text_hash': text_hash, 'image': data,
+                      'format': CAPTION_FORMAT })
+                written += 1
+    db.commit()
+    db.close()
+    print(' * %d captioned snapshots' % written)
+
+
+def _init_worker(font_path, font_size, max_width, quality):
+    global _font, _max_width, _quality
+    _font = load_font(font_path, font_size)
+    _max_width = max_width
+    _quality = quality
+
+
+def _render(job):
+    data, text = job
+    image = images.decode(data).convert('RGB')
+    draw(image, '', text, font=_font, max_width=_max_width)
+    return images.encode(image, CAPTION_FORMAT, quality=_quality)
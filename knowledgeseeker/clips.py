@@ -1,115 +1,137 @@
 import flask
-import io
-import textwrap as tw
 from base64 import b64decode
 from datetime import timedelta
 from pathlib import Path
 
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageChops
-
+import knowledgeseeker.admission as admission
+import knowledgeseeker.captions as captions
+import knowledgeseeker.encoding as encoding
 import knowledgeseeker.ffmpeg as ff
+import knowledgeseeker.framecache as framecache
+import knowledgeseeker.images as images
 from knowledgeseeker.database import get_db, match_episode
 from knowledgeseeker.utils import set_expires
 
 
 bp = flask.Blueprint('clips', __name__)
 
-TEXT_VMARGIN = 0.1
-TEXT_SPACING = 4
 JPEG_QUALITY = 85
+MAX_MP4_LENGTH = timedelta(seconds=30)
+CLIP_MIMETYPES = { 'gif': 'image/gif',
+                   'webm': 'video/webm',
+                   'webp': 'image/webp',
+                   'mp4': 'video/mp4' }
+# Formats a clip can switch to when its own can't meet a size budget, by
+# preference, if the client accepts them.
+BUDGET_FALLBACKS = ['webp', 'mp4']
+BUDGET_ATTEMPTS = 3
 
 
 @bp.route('/<season>/<episode>/<int:ms>/pic')
 @set_expires
 @match_episode
 def snapshot(season_id, episode_id, ms):
-    # Load PNG from database.
-    cur = get_db().cursor()
-    cur.execute(
-        'SELECT png FROM snapshot'
-        ' WHERE episode_id=:episode_id AND ms=:ms',
-        { 'episode_id': episode_id, 'ms': ms })
-    res = cur.fetchone()
-    if res is None:
-        flask.abort(404, 'time not found')
-    image = Image.open(io.BytesIO(res['png']))
-
-    # Draw text if requested.
     top_text = (b64decode(flask.request.args.get('topb64', ''))
         .decode('ascii', 'ignore'))
     bottom_text = (b64decode(flask.request.args.get('btmb64', ''))
         .decode('ascii', 'ignore'))
+
+    # Captions pre-rendered at ingest are sent as they are.
+    if top_text != '' or bottom_text != '':
+        res = load_caption(episode_id, ms, top_text, bottom_text)
+        if res is not None:
+            return image_response(res['image'], res['format'])
+
+    accept = flask.request.accept_mimetypes
+    serve_formats = flask.current_app.config.get('SERVE_FORMATS', ['jpeg'])
+    fmt = images.negotiate(accept, serve_formats)
+    res = load_snapshot(episode_id, ms, fmt=fmt)
+
+    # Pass the stored image through untouched if the client can take it.
+    if (top_text == '' and bottom_text == '' and res['format'] in serve_formats
+            and images.accepts(accept, res['format'])):
+        return image_response(res['image'], res['format'])
+
+    # Draw text if requested.
+    image = images.decode(res['image'])
     if top_text != '' or bottom_text != '':
         drawtext(image, top_text, bottom_text)
 
-    # Return as compressed JPEG.
-    res = io.BytesIO()
-    image.save(res, 'jpeg', quality=JPEG_QUALITY)
-    return flask.Response(res.getvalue(), mimetype='image/jpeg')
+    # Return in the best format the client accepts.
+    data = images.encode(
+        image, fmt,
+        quality=flask.current_app.config.get('SERVE_QUALITY', JPEG_QUALITY))
+    return image_response(data, fmt)
 
 
 @bp.route('/<season>/<episode>/<int:ms>/pic/tiny')
 @set_expires
 @match_episode
 def snapshot_tiny(season_id, episode_id, ms):
+    res = load_snapshot(episode_id, ms, tiny=True)
+    if images.accepts(flask.request.accept_mimetypes, res['format']):
+        return image_response(res['image'], res['format'])
+    else:
+        data = images.encode(images.decode(res['image']), 'jpeg',
+                             quality=JPEG_QUALITY)
+        return image_response(data, 'jpeg')
+
+
+def load_snapshot(episode_id, ms, tiny=False, fmt=None):
+    # Stored frames come from the database; any other time within the
+    # episode is rendered on demand, if enabled, and cached in fmt.
     cur = get_db().cursor()
-    cur.execute(
-        'SELECT jpeg FROM snapshot_tiny '
-        ' WHERE episode_id=:episode_id AND ms=:ms',
-        { 'episode_id': episode_id, 'ms': ms })
+    if tiny:
+        cur.execute(
+            'SELECT frame_tiny.image, frame_tiny.format FROM snapshot '
+            '       INNER JOIN frame_tiny ON frame_tiny.id = snapshot.frame_id '
+            ' WHERE snapshot.episode_id=:episode_id AND snapshot.ms=:ms',
+            { 'episode_id': episode_id, 'ms': ms })
+    else:
+        cur.execute(
+            'SELECT frame.image, frame.format FROM snapshot '
+            '       INNER JOIN frame ON frame.id = snapshot.frame_id '
+            ' WHERE snapshot.episode_id=:episode_id AND snapshot.ms=:ms',
+            { 'episode_id': episode_id, 'ms': ms })
     res = cur.fetchone()
-    if res is None:
+    if res is not None:
+        return res
+    if not framecache.enabled():
         flask.abort(404, 'time not found')
-    return flask.Response(res['jpeg'], mimetype='image/jpeg')
+
+    cur.execute('SELECT duration, video_path FROM episode WHERE id=:episode_id',
+                { 'episode_id': episode_id })
+    episode = cur.fetchone()
+    if ms > episode['duration']:
+        flask.abort(404, 'time not found')
+    data, fmt = framecache.get_frame(episode_id, episode['video_path'], ms,
+                                     tiny=tiny, fmt=fmt)
+    if data is None:
+        flask.abort(404, 'time not found')
+    return { 'image': data, 'format': fmt }
+
+
+def image_response(data, fmt):
+    response = flask.Response(data, mimetype=images.MIMETYPES[fmt])
+    response.vary.add('Accept')
+    return response
 
 
 def drawtext(image, top_text, bottom_text):
-    MAX_WIDTH = flask.current_app.config.get('PIL_MAXWIDTH')
-    MAX_LENGTH = MAX_WIDTH*2
-
-    font_path = flask.current_app.config.get('PIL_FONT', None)
-    font = (ImageFont.truetype(
-            font=str(font_path),
-            size=flask.current_app.config.get('PIL_FONT_SIZE'))
-        if font_path is not None else None)
-    draw = ImageDraw.Draw(image)
-    def wrap(t):
-        return '\n'.join(tw.wrap(t, width=MAX_WIDTH))
-
-    if top_text != '':
-        text = wrap(top_text[:MAX_LENGTH])
-        size = draw.multiline_textsize(text, font=font, spacing=TEXT_SPACING)
-        pos = (round(image.width/2 - size[0]/2), round(TEXT_VMARGIN*image.height))
-
-        blurred = Image.new('RGBA', image.size)
-        blurredDraw = ImageDraw.Draw(blurred)
-        blurredDraw.multiline_text(pos, text, fill='black', font=font,
-                                   spacing=TEXT_SPACING, align='center')
-        blurred = blurred.filter(ImageFilter.BoxBlur(7))
-
-        # Paste soft text onto background
-        image.paste(blurred,blurred)
-
-        draw.multiline_text(pos, text, font=font,
-                            spacing=TEXT_SPACING, align='center')
-
-    if bottom_text != '':
-        text = wrap(bottom_text[:MAX_LENGTH])
-        size = draw.multiline_textsize(text, font=font, spacing=TEXT_SPACING)
-        pos = (round(image.width/2 - size[0]/2),
-               image.height - round(TEXT_VMARGIN*image.height) - size[1])
-
-        blurred = Image.new('RGBA', image.size)
-        blurredDraw = ImageDraw.Draw(blurred)
-        blurredDraw.multiline_text(pos, text, fill='black', font=font,
-                                   spacing=TEXT_SPACING, align='center')
-        blurred = blurred.filter(ImageFilter.BoxBlur(7))
-
-        # Paste soft text onto background
-        image.paste(blurred,blurred)
-
-        draw.multiline_text(pos, text, font=font,
-                            spacing=TEXT_SPACING, align='center')
+    font = captions.load_font(flask.current_app.config.get('PIL_FONT', None),
+                              flask.current_app.config.get('PIL_FONT_SIZE'))
+    captions.draw(image, top_text, bottom_text, font=font,
+                  max_width=flask.current_app.config.get('PIL_MAXWIDTH'))
+
+
+def load_caption(episode_id, ms, top_text, bottom_text):
+    cur = get_db().cursor()
+    cur.execute(
+        'SELECT image, format FROM caption '
+        ' WHERE episode_id=:episode_id AND ms=:ms AND text_hash=:text_hash',
+        { 'episode_id': episode_id, 'ms': ms,
+          'text_hash': captions.caption_hash(top_text, bottom_text) })
+    return cur.fetchone()
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/gif')
@@ -126,7 +148,7 @@ def gif(season_id, episode_id, ms1, ms2):
     res = cur.fetchone()
     video_path = res['video_path']
 
-    return flask.Response(ff.make_gif(video_path, ms1, ms2), mimetype='image/gif')
+    return render_clip('gif', video_path, None, ms1, ms2)
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/gif/sub')
@@ -145,9 +167,7 @@ def gif_with_subtitles(season_id, episode_id, ms1, ms2):
     video_path = res['video_path']
     subtitles_path = res['subtitles_path']
 
-    return flask.Response(
-        ff.make_gif_with_subtitles(video_path, subtitles_path, ms1, ms2),
-        mimetype='image/gif')
+    return render_clip('gif/sub', video_path, subtitles_path, ms1, ms2)
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/webm')
@@ -164,7 +184,7 @@ def webm(season_id, episode_id, ms1, ms2):
     res = cur.fetchone()
     video_path = res['video_path']
 
-    return flask.Response(ff.make_webm(video_path, ms1, ms2), mimetype='video/webm')
+    return render_clip('webm', video_path, None, ms1, ms2)
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/webm/sub')
@@ -183,9 +203,110 @@ def webm_with_subtitles(season_id, episode_id, ms1, ms2):
     video_path = res['video_path']
     subtitles_path = res['subtitles_path']
 
-    return flask.Response(
-        ff.make_webm_with_subtitles(video_path, subtitles_path, ms1, ms2),
-        mimetype='video/webm')
+    return render_clip('webm/sub', video_path, subtitles_path, ms1, ms2)
+
+
+@bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/mp4')
+@set_expires
+@match_episode
+def mp4(season_id, episode_id, ms1, ms2):
+    if not check_range(episode_id, ms1, ms2,
+                       flask.current_app.config.get('MAX_MP4_LENGTH',
+                                                    MAX_MP4_LENGTH)):
+        flask.abort(400, 'bad time range')
+
+    cur = get_db().cursor()
+    cur.execute('SELECT video_path FROM episode WHERE id=:episode_id',
+                { 'episode_id': episode_id })
+    res = cur.fetchone()
+    video_path = res['video_path']
+
+    exact = flask.request.args.get('exact', '0') not in ('', '0')
+    if not ff.can_copy_mp4(video_path):
+        admission.charge(admission.clip_cost(admission.REENCODE_MP4_COST))
+    data = ff.make_mp4(video_path, ms1, ms2, exact=exact)
+    return flask.Response(data, mimetype='video/mp4')
+
+
+def render_clip(kind, video_path, subtitles_path, ms1, ms2):
+    max_bytes = flask.request.args.get('max_bytes', None, type=int)
+    if max_bytes is None:
+        profile = clip_profile(kind, ms2 - ms1)
+        return clip_response(
+            make_clip(profile, video_path, subtitles_path, ms1, ms2), profile)
+    elif max_bytes <= 0:
+        flask.abort(400, 'bad size budget')
+
+    # Budgeted clips are small, so they are rendered in full and checked.
+    # If one comes out too big, aim lower by the amount it missed by, unless
+    # that would only render the same thing again.
+    formats = [fmt for fmt in BUDGET_FALLBACKS
+               if accepts_clip_format(flask.request.accept_mimetypes, fmt)]
+    target = max_bytes
+    profile = None
+    attempt = 0
+    while attempt < BUDGET_ATTEMPTS:
+        choice = encoding.choose_budget_profile(kind, ms2 - ms1, target,
+                                                formats=formats)
+        if profile is not None:
+            if choice.rendition() == profile.rendition():
+                break
+            # The route's cost paid for the first render only.
+            admission.charge(admission.request_cost())
+        profile = choice
+        attempt += 1
+        data = b''.join(make_clip(profile, video_path, subtitles_path,
+                                  ms1, ms2))
+        if len(data) <= max_bytes or len(data) == 0:
+            break
+        target *= max_bytes/len(data)
+    response = clip_response(data, profile)
+    response.vary.add('Accept')
+    response.headers.set(
+        'X-Size-Budget', 'max-bytes=%d; bytes=%d; attempts=%d; met=%s'
+        % (max_bytes, len(data), attempt,
+           'yes' if len(data) <= max_bytes else 'no'))
+    return response
+
+
+def make_clip(profile, video_path, subtitles_path, ms1, ms2):
+    if profile.format == 'gif' and subtitles_path is None:
+        return ff.make_gif(video_path, ms1, ms2, profile)
+    elif profile.format == 'gif':
+        return ff.make_gif_with_subtitles(video_path, subtitles_path,
+                                          ms1, ms2, profile)
+    elif profile.format == 'webm' and subtitles_path is None:
+        return ff.make_webm(video_path, ms1, ms2, profile)
+    elif profile.format == 'webm':
+        return ff.make_webm_with_subtitles(video_path, subtitles_path,
+                                           ms1, ms2, profile)
+    elif profile.format == 'webp':
+        return ff.make_animated_webp(video_path, subtitles_path,
+                                     ms1, ms2, profile)
+    elif profile.format == 'mp4':
+        return ff.make_silent_mp4(video_path, subtitles_path, ms1, ms2, profile)
+
+
+def accepts_clip_format(accept_mimetypes, fmt):
+    # Only explicit mentions count; a client asking for a GIF may not be able
+    # to play video at all.
+    if fmt in images.MIMETYPES:
+        return images.accepts(accept_mimetypes, fmt)
+    return any(value in (CLIP_MIMETYPES[fmt], 'video/*') and quality > 0
+               for value, quality in accept_mimetypes)
+
+
+def clip_profile(kind, length_ms):
+    tier = flask.request.args.get('tier', 'auto')
+    if tier not in encoding.TIERS:
+        flask.abort(400, 'bad quality tier')
+    return encoding.choose_profile(kind, length_ms, tier=tier)
+
+
+def clip_response(stream, profile):
+    response = flask.Response(stream, mimetype=CLIP_MIMETYPES[profile.format])
+    response.headers.set('X-Encoder-Profile', profile.header())
+    return response
 
 
 def check_range(episode_id, ms1, ms2, max_length):
@@ -201,6 +322,8 @@ def check_range(episode_id, ms1, ms2, max_length):
 
 
 def check_time(episode_id, ms):
+    if framecache.enabled():
+        return True
     cur = get_db().cursor()
     cur.execute('SELECT ms FROM snapshot WHERE episode_id=:episode_id AND ms=:ms',
                 { 'episode_id': episode_id, 'ms': ms })
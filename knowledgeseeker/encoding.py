@@ -0,0 +1,266 @@
+import math
+import os
+import threading
+from datetime import timedelta
+
+from flask import current_app
+
+
+TIERS = ('auto', 'preview', 'final')
+LATENCY_TARGET = timedelta(seconds=5)
+MAX_THREADS = 8
+# Base cost of a render in seconds of wall time per second of clip, at the
+# configured resolution on one thread. These are starting guesses; they are
+# refined from every finished render.
+BASE_COSTS = { 'gif': 0.6, 'webm': 1.5, 'mp4': 0.5 }
+SUBTITLES_COST = 1.2
+# VP9 speed settings in order of increasing speed, with their relative cost.
+CPU_USED_STEPS = [(2, 1.0), (4, 0.55), (6, 0.3), (8, 0.2)]
+SCALE_STEPS = [1.0, 0.75, 0.5]
+EWMA_ALPHA = 0.2
+
+# Size budgets. Frame rates are tried as given, with None keeping the source
+# rate, which is assumed to be SOURCE_FPS for estimates.
+SOURCE_FPS = 24
+FPS_STEPS = [None, 15, 10, 8]
+COLOR_STEPS = [256, 128, 64, 32]
+# Bytes per frame per line of vertical resolution squared, at 256 colors for
+# GIF. Refined from every finished render, like the time costs.
+BASE_BYTE_COSTS = { 'gif': 0.16, 'webp': 0.05 }
+WEBP_QUALITY = 60
+# Bitrate-controlled formats drop resolution and frame rate rather than
+# starve each pixel of bits below this.
+MIN_BITS_PER_PIXEL = 0.05
+ASPECT = 16/9
+# Aim under the budget, since encoders only roughly hit their targets.
+BUDGET_HEADROOM = 0.9
+
+_lock = threading.Lock()
+_active = 0
+_costs = {}
+_byte_costs = {}
+
+
+class EncoderProfile(object):
+    __slots__ = ('kind', 'tier', 'base_vres', 'vres', 'threads', 'cpu_used',
+                 'deadline', 'crf', 'dither', 'bayer_scale', 'predicted',
+                 'format', 'fps', 'colors', 'bitrate', 'predicted_bytes')
+
+    def __init__(self, kind, tier, base_vres, vres, threads=1, cpu_used=2,
+                 deadline='good', crf=35, dither='bayer', bayer_scale=5,
+                 predicted=None, format=None, fps=None, colors=256,
+                 bitrate=None, predicted_bytes=None):
+        self.kind = kind
+        self.tier = tier
+        self.base_vres = base_vres
+        self.vres = vres
+        self.threads = threads
+        self.cpu_used = cpu_used
+        self.deadline = deadline
+        self.crf = crf
+        self.dither = dither
+        self.bayer_scale = bayer_scale
+        self.predicted = predicted
+        self.format = format if format is not None else kind.split('/')[0]
+        self.fps = fps
+        self.colors = colors
+        self.bitrate = bitrate
+        self.predicted_bytes = predicted_bytes
+
+    def rendition(self):
+        # The settings that decide what comes out, leaving aside how fast.
+        return (self.format, self.vres, self.fps, self.colors, self.bitrate)
+
+    def header(self):
+        header = ('tier=%s; format=%s; vres=%d; threads=%d; cpu-used=%d'
+                  % (self.tier, self.format, self.vres, self.threads,
+                     self.cpu_used))
+        if self.fps is not None:
+            header += '; fps=%d' % self.fps
+        if self.format == 'gif':
+            header += '; colors=%d' % self.colors
+        if self.bitrate is not None:
+            header += '; bitrate=%d' % self.bitrate
+        return header
+
+
+def render_slots():
+    return current_app.config.get('RENDER_SLOTS') or os.cpu_count() or 1
+
+
+def occupancy():
+    # Renders in flight in this process, or the system load if other workers
+    # are keeping the box busier than that.
+    slots = render_slots()
+    try:
+        load = os.getloadavg()[0]/(os.cpu_count() or 1)
+    except OSError:
+        load = 0.0
+    return max(_active/slots, load)
+
+
+def begin_render():
+    global _active
+    with _lock:
+        _active += 1
+
+
+def end_render(profile, length_ms, elapsed, n_bytes=None):
+    # Called once the output has been streamed, possibly outside of the app
+    # context, with elapsed=None if the render didn't complete.
+    global _active
+    with _lock:
+        _active -= 1
+        if elapsed is None or length_ms <= 0:
+            return
+        if profile.format in BASE_BYTE_COSTS and n_bytes is not None:
+            old = _byte_costs.get(profile.format, BASE_BYTE_COSTS[profile.format])
+            units = _size_units(profile.format, length_ms, profile.vres,
+                                profile.fps, profile.colors)
+            _byte_costs[profile.format] = old + EWMA_ALPHA*(n_bytes/units - old)
+        if profile.format != profile.kind.split('/')[0]:
+            # Fallback formats don't say anything about the kind's speed.
+            return
+        # Back out the work this render represents and fold it into the cost
+        # estimate for its kind.
+        work = (length_ms/1000*(profile.vres/profile.base_vres)**2
+                *_speed_factor(profile.kind, profile.cpu_used)/profile.threads
+                *(profile.fps or SOURCE_FPS)/SOURCE_FPS)
+        old = _costs.get(profile.kind, _initial_cost(profile.kind))
+        _costs[profile.kind] = old + EWMA_ALPHA*(elapsed/work - old)
+
+
+def choose_profile(kind, length_ms, tier='auto'):
+    base_vres = _base_vres(kind)
+    slots = render_slots()
+    free = max(0.0, 1.0 - occupancy())
+    threads = max(1, min(MAX_THREADS, round(slots*free)))
+
+    if tier == 'preview':
+        return EncoderProfile(kind, tier, base_vres,
+                              _even(base_vres*SCALE_STEPS[-1]),
+                              threads=threads, cpu_used=8, deadline='realtime',
+                              crf=40)
+    elif tier == 'final':
+        return EncoderProfile(kind, tier, base_vres, base_vres, threads=threads)
+
+    # Pick the highest quality settings predicted to meet the latency target.
+    target = current_app.config.get('RENDER_LATENCY_TARGET', LATENCY_TARGET)
+    target = target.total_seconds()
+    steps = [(scale, cpu_used) for scale in SCALE_STEPS
+             for cpu_used, _ in CPU_USED_STEPS]
+    if kind.startswith('gif'):
+        # GIF encoding has no speed setting; only resolution helps.
+        steps = [(scale, 2) for scale in SCALE_STEPS]
+    for scale, cpu_used in steps:
+        vres = _even(base_vres*scale)
+        predicted = predict(kind, length_ms, base_vres, vres, threads, cpu_used)
+        if predicted <= target:
+            break
+    return EncoderProfile(kind, tier, base_vres, vres,
+                          threads=threads, cpu_used=cpu_used,
+                          deadline='realtime' if cpu_used >= 8 else 'good',
+                          predicted=predicted)
+
+
+def choose_budget_profile(kind, length_ms, max_bytes, formats=('gif',)):
+    # Picks the encoding expected to come closest to max_bytes without going
+    # over. GIF and animated WebP sizes are estimated from past renders;
+    # WebM and MP4 are given a bitrate. formats are the fallbacks the client
+    # can take, in order of preference, after the route's own format.
+    base_vres = _base_vres(kind)
+    free = max(0.0, 1.0 - occupancy())
+    threads = max(1, min(MAX_THREADS, round(render_slots()*free)))
+    target = max_bytes*BUDGET_HEADROOM
+    def profile(fmt, **kwargs):
+        return EncoderProfile(kind, 'budget', base_vres, format=fmt,
+                              threads=threads, cpu_used=4, **kwargs)
+
+    own = kind.split('/')[0]
+    for fmt in [own] + [f for f in formats if f != own]:
+        if fmt in BASE_BYTE_COSTS:
+            best = None
+            for scale in SCALE_STEPS:
+                for fps in FPS_STEPS:
+                    for colors in (COLOR_STEPS if fmt == 'gif' else [256]):
+                        vres = _even(base_vres*scale)
+                        size = predict_bytes(fmt, length_ms, vres, fps, colors)
+                        quality = _quality(scale, fps, colors)
+                        if size <= target and (best is None
+                                               or quality > best[0]):
+                            best = (quality, size, vres, fps, colors)
+            if best is not None:
+                _, size, vres, fps, colors = best
+                return profile(fmt, vres=vres, fps=fps, colors=colors,
+                               predicted_bytes=round(size))
+        else:
+            bitrate = int(target*8/(length_ms/1000))
+            steps = [(scale, fps) for scale in SCALE_STEPS for fps in FPS_STEPS]
+            for scale, fps in steps:
+                vres = _even(base_vres*scale)
+                bpp = bitrate/((fps or SOURCE_FPS)*vres*vres*ASPECT)
+                if bpp >= MIN_BITS_PER_PIXEL:
+                    break
+            return profile(fmt, vres=vres, fps=fps, bitrate=bitrate,
+                           predicted_bytes=round(target))
+
+    # Nothing is expected to fit; send the smallest rendition there is.
+    vres = _even(base_vres*SCALE_STEPS[-1])
+    fmt = own
+    return profile(fmt, vres=vres, fps=FPS_STEPS[-1], colors=COLOR_STEPS[-1],
+                   predicted_bytes=round(predict_bytes(
+                       fmt, length_ms, vres, FPS_STEPS[-1], COLOR_STEPS[-1])))
+
+
+def predict_bytes(fmt, length_ms, vres, fps, colors=256):
+    with _lock:
+        cost = _byte_costs.get(fmt, BASE_BYTE_COSTS[fmt])
+    return cost*_size_units(fmt, length_ms, vres, fps, colors)
+
+
+def _quality(scale, fps, colors):
+    # A rough ranking of what viewers miss most: resolution, then smooth
+    # motion, with banding from small palettes worst of all.
+    return (scale**2*((fps or SOURCE_FPS)/SOURCE_FPS)**0.5
+            *(math.log2(colors)/8)**2)
+
+
+def _size_units(fmt, length_ms, vres, fps, colors):
+    units = length_ms/1000*(fps or SOURCE_FPS)*vres*vres
+    if fmt == 'gif':
+        units *= math.log2(colors)/8
+    return units
+
+
+def predict(kind, length_ms, base_vres, vres, threads, cpu_used):
+    with _lock:
+        cost = _costs.get(kind, _initial_cost(kind))
+    return (length_ms/1000*cost*(vres/base_vres)**2
+            *_speed_factor(kind, cpu_used)/threads)
+
+
+def _initial_cost(kind):
+    cost = BASE_COSTS[kind.split('/')[0]]
+    if kind.endswith('/sub'):
+        cost *= SUBTITLES_COST
+    return cost
+
+
+def _speed_factor(kind, cpu_used):
+    if kind.startswith('gif'):
+        return 1.0
+    for step, factor in CPU_USED_STEPS:
+        if cpu_used <= step:
+            return factor
+    return CPU_USED_STEPS[-1][1]
+
+
+def _base_vres(kind):
+    if kind.startswith('gif'):
+        return current_app.config.get('GIF_VRES')
+    else:
+        return current_app.config.get('WEBM_VRES')
+
+
+def _even(value):
+    return max(2, int(value)//2*2)
@@ -0,0 +1,141 @@
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+from flask import current_app, g, url_for
+from flask.cli import with_appcontext
+
+from knowledgeseeker.database import connect, is_read, shard_names
+
+
+EXPORT_WORKERS = 4
+
+# Worker-local app, created once per process by _init_worker().
+_app = None
+
+
+def init_app(app):
+    app.cli.add_command(export_static_command)
+
+
+@click.command('export-static')
+@click.argument('out_dir', type=click.Path(file_okay=False))
+@click.option('--workers', default=EXPORT_WORKERS, show_default=True,
+              help='Number of rendering processes.')
+@with_appcontext
+def export_static_command(out_dir, workers):
+    """Render all pages and images determined by the database to OUT_DIR."""
+    out_dir = Path(out_dir).resolve()
+    jobs = []
+    if current_app.config.get('LIBRARIES'):
+        with current_app.test_request_context():
+            jobs.append(('libraries', [url_for('shards.index'),
+                                       url_for('shards.about')]))
+    for shard in shard_names():
+        if not is_read(shard):
+            print('Skipping %s: not read yet' % (shard or 'library'))
+            continue
+        jobs += collect_urls(shard)
+    written = unchanged = skipped = 0
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker) as executor:
+        futures = [executor.submit(_export_urls, str(out_dir), urls)
+                   for label, urls in jobs]
+        for (label, urls), future in zip(jobs, futures):
+            w, u, s = future.result()
+            written += w
+            unchanged += u
+            skipped += s
+            print(' * %s - %d written, %d unchanged, %d skipped'
+                  % (label, w, u, s))
+    print('%d written, %d unchanged, %d skipped' % (written, unchanged, skipped))
+
+
+def collect_urls(shard=None):
+    # Batch by episode so each worker gets a sizeable chunk of moment pages
+    # and snapshots at a time.
+    db = connect(shard)
+    cur = db.cursor()
+    prefix = '%s/' % shard if shard is not None else ''
+    with current_app.test_request_context():
+        g.shard = shard
+        urls = [url_for('webui.index'), url_for('webui.about')]
+        cur.execute('SELECT id, slug FROM season')
+        seasons = cur.fetchall()
+        for season in seasons:
+            urls.append(url_for('webui.browse_season', season=season['slug']))
+            urls.append(url_for('webui.season_icon', season=season['slug']))
+        yield prefix + 'index', urls
+
+        for season in seasons:
+            cur.execute('SELECT id, slug FROM episode WHERE season_id=:season_id',
+                        { 'season_id': season['id'] })
+            for episode in cur.fetchall():
+                slug_kwargs = { 'season': season['slug'],
+                                'episode': episode['slug'] }
+                # Exported pages can't fetch further subtitles, so they list
+                # all of them.
+                urls = [url_for('webui.browse_episode', all=1, **slug_kwargs)]
+                ecur = db.cursor()
+                ecur.execute('SELECT ms FROM snapshot WHERE episode_id=:episode_id',
+                             { 'episode_id': episode['id'] })
+                for row in ecur:
+                    urls.append(url_for('webui.browse_moment',
+                                        ms=row['ms'], **slug_kwargs))
+                    urls.append(url_for('clips.snapshot',
+                                        ms=row['ms'], **slug_kwargs))
+                    urls.append(url_for('clips.snapshot_tiny',
+                                        ms=row['ms'], **slug_kwargs))
+                yield (prefix + '%s/%s' % (season['slug'], episode['slug']),
+                       urls)
+    db.close()
+
+
+def _init_worker():
+    global _app
+    from knowledgeseeker import create_app
+    _app = create_app()
+
+
+def _export_urls(out_dir, urls):
+    written = unchanged = skipped = 0
+    client = _app.test_client()
+    for url in urls:
+        # Close each response so streamed bodies release their app context
+        # (and any profiling capture) before the next request.
+        with client.get(url) as response:
+            if response.status_code != 200:
+                skipped += 1
+                continue
+            path = export_path(Path(out_dir), url, response.mimetype)
+            data = response.get_data()
+        if write_if_changed(path, data):
+            written += 1
+        else:
+            unchanged += 1
+    return written, unchanged, skipped
+
+
+def export_path(out_dir, url, mimetype):
+    # Every URL becomes a directory with an index file, since /pic is both a
+    # resource and the parent of /pic/tiny.
+    if mimetype == 'text/html':
+        ext = '.html'
+    else:
+        ext = mimetypes.guess_extension(mimetype) or ''
+    return out_dir/url.split('?')[0].strip('/')/('index%s' % ext)
+
+
+def write_if_changed(path, data):
+    if path.exists() and path.stat().st_size == len(data):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
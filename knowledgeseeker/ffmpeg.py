@@ -1,8 +1,27 @@
 import subprocess
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
 import ffmpeg
 from flask import current_app
 
+import knowledgeseeker.encoding as encoding
+
+
+READ_SIZE = 64*1024
+# Codecs that can be copied into an MP4 without re-encoding.
+MP4_VIDEO_CODECS = ('h264',)
+MP4_AUDIO_CODECS = ('aac',)
+# libx264 names for the H.264 profiles ffprobe reports.
+X264_PROFILES = { 'Baseline': 'baseline',
+                  'Constrained Baseline': 'baseline',
+                  'Main': 'main',
+                  'High': 'high',
+                  'High 10': 'high10',
+                  'High 4:2:2': 'high422',
+                  'High 4:4:4 Predictive': 'high444' }
+
 
 class FfmpegRuntimeError(Exception):
     pass
@@ -12,131 +31,347 @@ class FfprobeRuntimeError(Exception):
     pass
 
 
-def make_snapshot(video_path, time, vres=720):
+def make_snapshot(video_path, ms, vres=720):
     stream = (ffmpeg
               .input(video_path,
-                     ss=time)
-              .filter_('scale', -1, vres, flags='fast_bilinear')
+                     ss=str(ms/1000))
+              .filter_('scale', -1, vres, flags='area')
               .output('pipe:1',
-                      format='apng',
+                      format='image2pipe',
+                      vcodec='png',
                       vframes=1,
-                      q=1,
                       threads=1))
     return ffmpeg_run_stdout(stream)
 
 
-def make_snapshot_with_subtitles(video_path, subtitle_path, time,
-                                 fonts_path=None, font=None):
-    stream = ffmpeg.input(video_path,
-                          ss=time)
-    stream = ffmpeg_subtitles_filter(stream, subtitle_path, time,
-                                     fonts_path=fonts_path, font=font)
-    stream = ffmpeg.output(stream, 'pipe:1',
-                           format='singlejpeg',
-                           vframes=1,
-                           q=1,
-                           threads=1)
-    return ffmpeg_run_stdout(stream)
-
-
-def make_tiny_snapshot(video_path, time, vres=100):
+def make_tiny_snapshot(video_path, ms, vres=100):
     stream = (ffmpeg
               .input(video_path,
-                     ss=time)
-              .filter_('scale', -1, vres, flags='fast_bilinear')
+                     ss=str(ms/1000))
+              .filter_('scale', -1, vres, flags='area')
               .output('pipe:1',
-                      format='singlejpeg',
+                      format='image2pipe',
+                      vcodec='mjpeg',
                       vframes=1,
                       q=5,
                       threads=1))
     return ffmpeg_run_stdout(stream)
 
 
-def make_gif(video_path, start_ms, end_ms):
+def make_gif(video_path, start_ms, end_ms, profile):
     start_s = str(start_ms/1000)
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
-    vres=current_app.config.get('GIF_VRES')
+    vres = profile.vres
 
     # Get color palette for the highest quality
     pstream = ffmpeg.input(video_path, ss=start_s, t=duration)
+    pstream = ffmpeg_fps_filter(pstream, profile)
     pstream = ffmpeg.filter_(pstream, 'scale', -1, vres)
-    pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full')
+    pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full',
+                             max_colors=profile.colors)
 
     # Create the actual jif
     gstream = ffmpeg.input(video_path, ss=start_s)
+    gstream = ffmpeg_fps_filter(gstream, profile)
     gstream = ffmpeg.filter_(gstream, 'scale', -1, vres)
     gstream = ffmpeg_paletteuse_filter(gstream, pstream,
-                                       dither='bayer',
-                                       bayer_scale=5,
-                                       diff_mode='rectangle')
-    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration, threads=1)
-    return ffmpeg_run_stdout(gstream)
+                                       **ffmpeg_dither_args(profile))
+    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration,
+                            threads=profile.threads)
+    return ffmpeg_run_render(gstream, profile, end_ms - start_ms)
 
 
-def make_gif_with_subtitles(video_path, subtitle_path, start_ms, end_ms):
+def make_gif_with_subtitles(video_path, subtitle_path, start_ms, end_ms, profile):
     start_s = str(start_ms/1000)
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
-    vres=current_app.config.get('GIF_VRES')
+    vres = profile.vres
 
     # Get color palette for the highest quality
     pstream = ffmpeg.input(video_path, ss=start_s, t=duration)
+    pstream = ffmpeg_fps_filter(pstream, profile)
     pstream = ffmpeg.filter_(pstream, 'scale', -1, vres)
     pstream = ffmpeg_subtitles_filter(pstream, subtitle_path, start_ms)
-    pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full')
+    pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full',
+                             max_colors=profile.colors)
 
     # Create the actual jif
     gstream = ffmpeg.input(video_path, ss=start_s)
+    gstream = ffmpeg_fps_filter(gstream, profile)
     gstream = ffmpeg.filter_(gstream, 'scale', -1, vres)
     gstream = ffmpeg_subtitles_filter(gstream, subtitle_path, start_ms)
-    gstream = ffmpeg_paletteuse_filter(gstream, pstream, dither='bayer',
-                                       bayer_scale=5, diff_mode='rectangle')
-    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration, threads=1)
-    return ffmpeg_run_stdout(gstream)
+    gstream = ffmpeg_paletteuse_filter(gstream, pstream,
+                                       **ffmpeg_dither_args(profile))
+    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration,
+                            threads=profile.threads)
+    return ffmpeg_run_render(gstream, profile, end_ms - start_ms)
 
 
-def make_webm(video_path, start_ms, end_ms):
+def make_webm(video_path, start_ms, end_ms, profile):
     start_s = str(start_ms/1000)
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
-    vres=current_app.config.get('WEBM_VRES')
 
     stream = ffmpeg.input(video_path, ss=start_s)
-    stream = ffmpeg.filter_(stream, 'scale', -1, vres)
+    stream = ffmpeg_fps_filter(stream, profile)
+    stream = ffmpeg.filter_(stream, 'scale', -1, profile.vres)
     stream = ffmpeg.output(stream, 'pipe:1',
-                           **{ 'format': 'webm',
-                               't': duration,
-                               'an': None,
-                               'sn': None,
-                               'c:v': 'libvpx-vp9',
-                               'crf': 35,
-                               'b:v': '1000k',
-                               'cpu-used': 2,
-                               'threads': 1 })
-    return ffmpeg_run_stdout(stream)
+                           **ffmpeg_webm_args(profile, duration))
+    return ffmpeg_run_render(stream, profile, end_ms - start_ms)
 
 
-def make_webm_with_subtitles(video_path, subtitle_path, start_ms, end_ms):
+def make_webm_with_subtitles(video_path, subtitle_path, start_ms, end_ms, profile):
     start_s = str(start_ms/1000)
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
-    vres=current_app.config.get('WEBM_VRES')
 
     stream = ffmpeg.input(video_path, ss=start_s)
-    stream = ffmpeg.filter_(stream, 'scale', -1, vres)
+    stream = ffmpeg_fps_filter(stream, profile)
+    stream = ffmpeg.filter_(stream, 'scale', -1, profile.vres)
     stream = ffmpeg_subtitles_filter(stream, subtitle_path, start_ms)
     stream = ffmpeg.output(stream, 'pipe:1',
-                           **{ 'format': 'webm',
-                               't': duration,
-                               'an': None,
-                               'sn': None,
-                               'c:v': 'libvpx-vp9',
-                               'crf': 35,
-                               'b:v': '1000k',
-                               'cpu-used': 2,
-                               'threads': 1 })
-    return ffmpeg_run_stdout(stream)
+                           **ffmpeg_webm_args(profile, duration))
+    return ffmpeg_run_render(stream, profile, end_ms - start_ms)
+
+
+def make_animated_webp(video_path, subtitle_path, start_ms, end_ms, profile):
+    start_s = str(start_ms/1000)
+    duration = str((end_ms - start_ms)/1000)
+
+    stream = ffmpeg.input(video_path, ss=start_s)
+    stream = ffmpeg_fps_filter(stream, profile)
+    stream = ffmpeg.filter_(stream, 'scale', -1, profile.vres)
+    if subtitle_path is not None:
+        stream = ffmpeg_subtitles_filter(stream, subtitle_path, start_ms)
+    stream = ffmpeg.output(stream, 'pipe:1',
+                           format='webp',
+                           t=duration,
+                           an=None,
+                           sn=None,
+                           loop=0,
+                           quality=encoding.WEBP_QUALITY,
+                           threads=profile.threads,
+                           **{ 'c:v': 'libwebp_anim' })
+    return ffmpeg_run_render(stream, profile, end_ms - start_ms)
+
+
+def make_silent_mp4(video_path, subtitle_path, start_ms, end_ms, profile):
+    # An H.264 stand-in for GIF, fragmented so it can be written to a pipe.
+    start_s = str(start_ms/1000)
+    duration = str((end_ms - start_ms)/1000)
+
+    stream = ffmpeg.input(video_path, ss=start_s)
+    stream = ffmpeg_fps_filter(stream, profile)
+    stream = ffmpeg.filter_(stream, 'scale', -2, profile.vres)
+    if subtitle_path is not None:
+        stream = ffmpeg_subtitles_filter(stream, subtitle_path, start_ms)
+    stream = ffmpeg.output(stream, 'pipe:1',
+                           format='mp4',
+                           t=duration,
+                           an=None,
+                           sn=None,
+                           preset='veryfast',
+                           pix_fmt='yuv420p',
+                           maxrate=profile.bitrate,
+                           bufsize=profile.bitrate,
+                           movflags='frag_keyframe+empty_moov+default_base_moof',
+                           threads=profile.threads,
+                           **{ 'c:v': 'libx264', 'b:v': profile.bitrate })
+    return ffmpeg_run_render(stream, profile, end_ms - start_ms)
+
+
+def make_mp4(video_path, start_ms, end_ms, exact=False):
+    # Cuts the clip out of the source with stream copy, so it starts on the
+    # keyframe at or before start_ms. With exact, only the frames between
+    # start_ms and the next keyframe are re-encoded and the rest is copied.
+    start_s = str(start_ms/1000)
+    duration = str((end_ms - start_ms)/1000)
+    video, audio_codec = probe_streams(video_path)
+    video_codec = video['codec_name'] if video is not None else None
+    audio_args = { 'c:a': 'copy' if audio_codec in MP4_AUDIO_CODECS else 'aac' }
+
+    with TemporaryDirectory() as tmp_dir:
+        out_path = str(Path(tmp_dir)/'clip.mp4')
+        if video_codec not in MP4_VIDEO_CODECS:
+            # Nothing to copy; encode the whole clip as fast as possible. This
+            # is a full render, so it counts towards the render pool.
+            vres = int(video.get('height') or 0) if video is not None else 0
+            profile = encoding.EncoderProfile('mp4', 'final', vres, vres)
+            encoding.begin_render()
+            start = time.monotonic()
+            elapsed = data = None
+            try:
+                ffmpeg_run(ffmpeg_mp4_output(
+                    ffmpeg.input(video_path, ss=start_s, t=duration),
+                    out_path, audio_codec, **{ 'c:v': 'libx264',
+                                               'preset': 'veryfast',
+                                               **audio_args }))
+                data = ffmpeg_read_file(out_path)
+                elapsed = time.monotonic() - start
+            finally:
+                encoding.end_render(profile, end_ms - start_ms,
+                                    elapsed if vres > 0 else None,
+                                    len(data) if data is not None else None)
+            return data
+
+        keyframe_ms = (next_keyframe(video_path, start_ms, end_ms)
+                       if exact else start_ms)
+        if keyframe_ms == start_ms:
+            ffmpeg_run(ffmpeg_mp4_output(
+                ffmpeg.input(video_path, ss=start_s, t=duration),
+                out_path, audio_codec, **{ 'c:v': 'copy',
+                                           'avoid_negative_ts': 'make_zero',
+                                           **audio_args }))
+            return ffmpeg_read_file(out_path)
+
+        # Re-encode the partial GOP, copy from the keyframe on, and join the
+        # two. An MP4 sample entry holds one set of SPS/PPS, and the copied
+        # part must not be decoded against the encoder's, so both parts are
+        # cut as MPEG-TS, which carries them in-band at every keyframe, and
+        # the join is remuxed with the avc3 sample entry, which tells players
+        # to use those. Audio is cut from the source separately so it runs
+        # uninterrupted across the join.
+        head_path = str(Path(tmp_dir)/'head.ts')
+        tail_path = str(Path(tmp_dir)/'tail.ts')
+        list_path = str(Path(tmp_dir)/'list.txt')
+        # The head is trimmed at the keyframe on source timestamps, since -t
+        # counts from the first frame rather than from start_ms; keyframe_ms
+        # is rounded, so the cut is half a millisecond early.
+        ffmpeg_run(ffmpeg.output(
+            ffmpeg.input(video_path, ss=start_s, copyts=None).video
+                .filter_('trim', end=str((keyframe_ms - 0.5)/1000)),
+            head_path, format='mpegts', an=None, sn=None,
+            **{ 'c:v': 'libx264', 'preset': 'veryfast',
+                **x264_matching_args(video) }))
+        if keyframe_ms < end_ms:
+            ffmpeg_run(ffmpeg.output(
+                ffmpeg.input(video_path, ss=str(keyframe_ms/1000),
+                             t=str((end_ms - keyframe_ms)/1000)).video,
+                tail_path, format='mpegts', an=None, sn=None,
+                **{ 'c:v': 'copy' }))
+        with open(list_path, 'w') as f:
+            f.write("file '%s'\n" % head_path)
+            if keyframe_ms < end_ms:
+                f.write("file '%s'\n" % tail_path)
+
+        vstream = ffmpeg.input(list_path, format='concat', safe=0).video
+        streams = [vstream]
+        if audio_codec is not None:
+            streams.append(ffmpeg.input(video_path, ss=start_s, t=duration).audio)
+        mp4_args = { 'c:v': 'copy', 'tag:v': 'avc3', **audio_args }
+        timescale = video_timescale(video)
+        if timescale is not None:
+            mp4_args['video_track_timescale'] = timescale
+        ffmpeg_run(ffmpeg.output(*streams, out_path, format='mp4', sn=None,
+                                 movflags='+faststart', **mp4_args))
+        return ffmpeg_read_file(out_path)
+
+
+def x264_matching_args(video):
+    # Encoder settings that keep re-encoded frames in the source's profile,
+    # level and pixel format, so players needn't reconfigure at the join.
+    args = { 'pix_fmt': video.get('pix_fmt') }
+    profile = X264_PROFILES.get(video.get('profile'))
+    if profile is not None:
+        args['profile:v'] = profile
+    level = video.get('level', -99)
+    if level > 9:
+        args['level'] = '%d.%d' % (level//10, level%10)
+    return { key: value for key, value in args.items() if value is not None }
+
+
+def video_timescale(video):
+    try:
+        num, den = video.get('time_base', '').split('/')
+        return int(den) if int(num) == 1 else None
+    except ValueError:
+        return None
+
+
+def ffmpeg_mp4_output(stream, out_path, audio_codec, **kwargs):
+    if audio_codec is None:
+        kwargs['an'] = None
+    return ffmpeg.output(stream, out_path, format='mp4', sn=None,
+                         movflags='+faststart', **kwargs)
+
+
+def can_copy_mp4(video_path):
+    # Whether make_mp4 can stream copy the video, rather than re-encode it.
+    video = probe_streams(video_path)[0]
+    return video is not None and video['codec_name'] in MP4_VIDEO_CODECS
+
+
+def probe_streams(video_path):
+    # Returns the ffprobe description of the first video stream, and the
+    # codec name of the first audio stream, or None for a missing stream.
+    try:
+        info = ffmpeg.probe(str(video_path),
+                            cmd=ffprobe_path())
+    except ffmpeg.Error as e:
+        raise FfprobeRuntimeError(e.stderr.decode('utf-8', 'ignore'))
+    video = audio_codec = None
+    for stream in info['streams']:
+        if stream['codec_type'] == 'video' and video is None:
+            video = stream
+        elif stream['codec_type'] == 'audio' and audio_codec is None:
+            audio_codec = stream['codec_name']
+    return video, audio_codec
+
+
+def ffprobe_path():
+    return current_app.config.get('FFPROBE_PATH', 'ffprobe')
+
+
+def next_keyframe(video_path, start_ms, end_ms):
+    # Time of the first keyframe at or after start_ms, or end_ms if there is
+    # none before the end of the clip. Only keyframes are decoded.
+    try:
+        info = ffmpeg.probe(str(video_path),
+                            cmd=ffprobe_path(),
+                            select_streams='v:0',
+                            skip_frame='nokey',
+                            show_entries='frame=best_effort_timestamp_time',
+                            read_intervals='%f%%%f' % (start_ms/1000,
+                                                       end_ms/1000))
+    except ffmpeg.Error as e:
+        raise FfprobeRuntimeError(e.stderr.decode('utf-8', 'ignore'))
+    for frame in info.get('frames', []):
+        try:
+            ms = round(float(frame['best_effort_timestamp_time'])*1000)
+        except (KeyError, ValueError):
+            continue
+        if start_ms <= ms < end_ms:
+            return ms
+    return end_ms
+
+
+def ffmpeg_fps_filter(stream, profile):
+    if profile.fps is None:
+        return stream
+    return ffmpeg.filter_(stream, 'fps', fps=profile.fps)
+
+
+def ffmpeg_dither_args(profile):
+    args = { 'dither': profile.dither, 'diff_mode': 'rectangle' }
+    if profile.dither == 'bayer':
+        args['bayer_scale'] = profile.bayer_scale
+    return args
+
+
+def ffmpeg_webm_args(profile, duration):
+    return { 'format': 'webm',
+             't': duration,
+             'an': None,
+             'sn': None,
+             'c:v': 'libvpx-vp9',
+             'crf': profile.crf,
+             'b:v': (profile.bitrate if profile.bitrate is not None
+                     else '1000k'),
+             'cpu-used': profile.cpu_used,
+             'deadline': profile.deadline,
+             'row-mt': 1 if profile.threads > 1 else 0,
+             'threads': profile.threads }
 
 
 def ffmpeg_subtitles_filter(stream, subtitle_path, start_ms):
@@ -163,16 +398,67 @@ def ffmpeg_paletteuse_filter(video_stream, palette_stream, **kwargs):
 
 
 def ffmpeg_run_stdout(stream):
+    return ffmpeg_popen(ffmpeg_args(stream), current_app.config.get('DEV')).stdout
+
+
+def ffmpeg_run_render(stream, profile, length_ms):
+    # Streams the output of a clip render, keeping track of it in the render
+    # pool's occupancy and timing it for the encoder profile estimates. The
+    # process only starts once the response starts streaming.
+    args = ffmpeg_args(stream)
+    dev = current_app.config.get('DEV')
+    def generate():
+        encoding.begin_render()
+        process = ffmpeg_popen(args, dev)
+        start = time.monotonic()
+        elapsed = None
+        n_bytes = 0
+        try:
+            while True:
+                chunk = process.stdout.read(READ_SIZE)
+                if not chunk:
+                    break
+                n_bytes += len(chunk)
+                yield chunk
+            if process.wait() == 0:
+                elapsed = time.monotonic() - start
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            encoding.end_render(profile, length_ms, elapsed, n_bytes)
+    return generate()
+
+
+def ffmpeg_run(stream):
+    # Runs ffmpeg to completion, for outputs written to files.
+    args = ffmpeg_args(stream.overwrite_output())
+    if current_app.config.get('DEV'):
+        print('\nRunning: %s\n' % ' '.join(args))
+    process = subprocess.run(args, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise FfmpegRuntimeError(process.stderr.decode('utf-8', 'ignore'))
+
+
+def ffmpeg_read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def ffmpeg_args(stream):
     # NOTE: nasty workaround for bad escaping by ffmpeg-python
     args = [str(a)
             .replace('\\\\\\\\\\\\\\', '\\\\\\')
             .replace('\\\\\\\\\\\\', '\\\\\\')
             for a in stream.get_args()]
-    args = [current_app.config.get('FFMPEG_PATH')] + args
-    if not current_app.config.get('DEV'):
-        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return [current_app.config.get('FFMPEG_PATH')] + args
+
+
+def ffmpeg_popen(args, dev=False):
+    if not dev:
+        return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     else:
         print('\nRunning: %s\n' % ' '.join(args))
-        process = subprocess.Popen(args, stdout=subprocess.PIPE)
-    return process.stdout
+        return subprocess.Popen(args, stdout=subprocess.PIPE)
 
@@ -0,0 +1,151 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import abort, current_app, g, make_response
+
+import knowledgeseeker.admission as admission
+import knowledgeseeker.ffmpeg as ff
+import knowledgeseeker.images as images
+from knowledgeseeker.database import shard_dir
+
+
+CACHE_DIR = 'frame-cache'
+ONDEMAND_WORKERS = 2
+# Renders queued or running at once, and how long a request waits for one,
+# before requests for new frames are turned away with a 503.
+ONDEMAND_QUEUE = 8
+ONDEMAND_TIMEOUT = 10
+RETRY_AFTER = 5
+CACHE_BYTES = 1024*1024*1024
+# Evict down to this fraction of the limit, so eviction doesn't run on every
+# write once the cache is full.
+EVICT_TO = 0.9
+
+_lock = threading.Lock()
+_executor = None
+_pending = {}
+_cache_bytes = {}
+
+
+def enabled():
+    return current_app.config.get('ONDEMAND_SNAPSHOTS', False)
+
+
+def get_frame(episode_id, video_path, ms, tiny=False, fmt=None):
+    # Returns the (data, format) of the exact frame at ms, rendering it with
+    # ffmpeg if it isn't cached yet. Identical requests in flight share one
+    # render. Full-size frames are cached in fmt, normally the format they
+    # are served in, so hits can be sent as they are.
+    rendered_fmt = 'jpeg' if tiny else 'png'
+    if tiny or fmt is None:
+        fmt = rendered_fmt
+    cache_dir = shard_dir(g.get('shard'))/CACHE_DIR
+    path = cache_dir/('%d-%d%s.%s' % (episode_id, ms, '-tiny' if tiny else '', fmt))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return data, fmt
+    except FileNotFoundError:
+        pass
+
+    admission.charge(admission.ONDEMAND_COST)
+    app = current_app._get_current_object()
+    vres = app.config.get('JPEG_TINY_VRES' if tiny else 'JPEG_VRES')
+    quality = app.config.get('SERVE_QUALITY', images.DEFAULT_QUALITY)
+    def render():
+        # The render caches its own frame, so one whose requests gave up
+        # waiting still serves the next request for it.
+        try:
+            with app.app_context():
+                if tiny:
+                    stdout = ff.make_tiny_snapshot(video_path, ms, vres=vres)
+                else:
+                    stdout = ff.make_snapshot(video_path, ms, vres=vres)
+                data = stdout.read()
+                if data != b'' and fmt != rendered_fmt:
+                    data = images.encode(images.decode(data), fmt,
+                                         quality=quality)
+                if data != b'':
+                    store(cache_dir, path, data)
+                return data
+        finally:
+            with _lock:
+                _pending.pop(path, None)
+
+    executor = get_executor()
+    max_queue = current_app.config.get('ONDEMAND_QUEUE', ONDEMAND_QUEUE)
+    with _lock:
+        future = _pending.get(path)
+        if future is None:
+            if len(_pending) >= max_queue:
+                busy()
+            future = _pending[path] = executor.submit(render)
+    try:
+        data = future.result(
+            timeout=current_app.config.get('ONDEMAND_TIMEOUT', ONDEMAND_TIMEOUT))
+    except TimeoutError:
+        busy()
+    if data == b'':
+        return None, fmt
+    return data, fmt
+
+
+def busy():
+    response = make_response('too many snapshots rendering', 503)
+    response.headers.set('Retry-After', str(RETRY_AFTER))
+    abort(response)
+
+
+def store(cache_dir, path, data):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('%s.%d.tmp' % (path.name, threading.get_ident()))
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    account(cache_dir, len(data))
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config.get('ONDEMAND_WORKERS',
+                                                   ONDEMAND_WORKERS))
+        return _executor
+
+
+def account(cache_dir, n_bytes):
+    limit = current_app.config.get('ONDEMAND_CACHE_BYTES', CACHE_BYTES)
+    with _lock:
+        if cache_dir not in _cache_bytes:
+            _cache_bytes[cache_dir] = sum(entry.stat().st_size
+                                          for entry in os.scandir(cache_dir))
+        else:
+            _cache_bytes[cache_dir] += n_bytes
+        if _cache_bytes[cache_dir] > limit:
+            _cache_bytes[cache_dir] = evict(cache_dir, round(limit*EVICT_TO))
+
+
+def evict(cache_dir, target_bytes):
+    # Least recently used first; hits refresh the modification time.
+    entries = []
+    for entry in os.scandir(cache_dir):
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= target_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
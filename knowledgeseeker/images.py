@@ -0,0 +1,125 @@
+import io
+
+from PIL import Image, ImageChops
+
+
+MIMETYPES = { 'png': 'image/png',
+              'jpeg': 'image/jpeg',
+              'webp': 'image/webp',
+              'avif': 'image/avif' }
+PIL_FORMATS = { 'png': 'PNG',
+                'jpeg': 'JPEG',
+                'webp': 'WEBP',
+                'avif': 'AVIF' }
+# Formats every client can display, regardless of its Accept header.
+UNIVERSAL_FORMATS = ('jpeg', 'png')
+LOSSLESS_FORMATS = ('png',)
+DEFAULT_QUALITY = 85
+MIN_QUALITY = 30
+PNG_COMPRESS_LEVEL = 1
+HASH_SIZE = 8
+HASH_MASK = (1 << HASH_SIZE*HASH_SIZE) - 1
+# Hashes are indexed as HASH_PARTS chunks for multi-index lookups.
+HASH_PARTS = 4
+CHUNK_BITS = HASH_SIZE*HASH_SIZE//HASH_PARTS
+
+
+def available_formats():
+    try:
+        # Older Pillow releases need the plugin to read and write AVIF.
+        import pillow_avif
+    except ImportError:
+        pass
+    Image.init()
+    return [fmt for fmt, pil_fmt in PIL_FORMATS.items() if pil_fmt in Image.SAVE]
+
+
+def encode(image, fmt, quality=None, max_bytes=None):
+    if quality is None:
+        quality = DEFAULT_QUALITY
+    data = _save(image, fmt, quality)
+    if (max_bytes is None or len(data) <= max_bytes
+            or fmt in LOSSLESS_FORMATS):
+        return data
+
+    # Binary search for the highest quality that fits the size target,
+    # settling for MIN_QUALITY if nothing does.
+    best = None
+    lo, hi = MIN_QUALITY, quality - 1
+    while lo <= hi:
+        mid = (lo + hi)//2
+        candidate = _save(image, fmt, mid)
+        if len(candidate) <= max_bytes:
+            best = candidate
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best if best is not None else _save(image, fmt, MIN_QUALITY)
+
+
+def _save(image, fmt, quality):
+    buf = io.BytesIO()
+    if fmt == 'png':
+        image.save(buf, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(buf, PIL_FORMATS[fmt], quality=quality)
+    return buf.getvalue()
+
+
+def decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def accepts(accept_mimetypes, fmt):
+    # Wildcards don't count for the newer formats; plenty of browsers send
+    # */* without being able to display WebP or AVIF.
+    if fmt in UNIVERSAL_FORMATS:
+        return True
+    return any(value == MIMETYPES[fmt] and quality > 0
+               for value, quality in accept_mimetypes)
+
+
+def negotiate(accept_mimetypes, formats):
+    for fmt in formats:
+        if accepts(accept_mimetypes, fmt):
+            return fmt
+    return 'jpeg'
+
+
+def dhash(image):
+    # 64-bit difference hash: one bit per horizontally adjacent pixel pair of
+    # a 9x8 grayscale thumbnail. Returned as a signed integer so it fits in
+    # an SQLite INTEGER.
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            idx = row*(HASH_SIZE + 1) + col
+            bits = (bits << 1) | (pixels[idx] > pixels[idx + 1])
+    if bits >= 1 << (HASH_SIZE*HASH_SIZE - 1):
+        bits -= 1 << HASH_SIZE*HASH_SIZE
+    return bits
+
+
+def hamming(a, b):
+    return bin((a ^ b) & HASH_MASK).count('1')
+
+
+def pixel_difference(a, b):
+    # The largest difference between corresponding pixels of two grayscale
+    # images, counting images of different sizes as entirely different.
+    if a.size != b.size:
+        return 255
+    low, high = ImageChops.difference(a, b).getextrema()
+    return high
+
+
+def hash_chunks(phash):
+    unsigned = phash & HASH_MASK
+    mask = (1 << CHUNK_BITS) - 1
+    return [(unsigned >> (CHUNK_BITS*part)) & mask for part in range(HASH_PARTS)]
@@ -0,0 +1,317 @@
+# The ingest engine. This is the only module that needs OpenCV and NumPy, so
+# it is imported lazily by read-library and never by the serving app.
+
+import sqlite3
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+import cv2
+import numpy
+from flask import current_app
+from PIL import Image
+
+import knowledgeseeker.images as images
+import knowledgeseeker.profiling as profiling
+from knowledgeseeker.database import connect, facet_tokens
+from knowledgeseeker.telemetry import EpisodeStats, IngestTelemetry
+from knowledgeseeker.utils import strip_html
+
+
+POPULATE_WORKERS = 4
+
+
+def populate(library_data, shard=None, log_path=None, progress=True):
+    # check_same_thread needed to allow threads to access tables not created
+    # by themselves (I like to live dangerously).
+    db = connect(shard, check_same_thread=False)
+    cur = db.cursor()
+    season_key = episode_key = 0
+    episodes = {}
+    for season in library_data:
+        cur.execute(
+            'INSERT INTO season (id, slug, icon_png, name) '
+            '       VALUES (:id, :slug, :icon_png, :name)',
+            { 'id': season_key,
+              'slug': season.slug,
+              'icon_png': season.read_icon(),
+              'name': season.name })
+        for episode in season.episodes:
+            cur.execute(
+                'INSERT INTO episode (id, slug, name, duration, '
+                '                     video_path, subtitles_path, season_id) '
+                '       VALUES (:id, :slug, :name, :duration, '
+                '               :video_path, :subtitles_path, :season_id)',
+                { 'id': episode_key,
+                  'slug': episode.slug,
+                  'name': episode.name,
+                  'duration': 0,
+                  'video_path': str(episode.video_path),
+                  'subtitles_path': str(episode.subtitles_path),
+                  'season_id': season_key })
+            episodes[episode_key] = episode
+            episode_key += 1
+        season_key += 1
+    db.commit()
+
+    config = { 'full_vres': current_app.config['JPEG_VRES'],
+               'tiny_vres': current_app.config['JPEG_TINY_VRES'],
+               'full_format': current_app.config.get('SNAPSHOT_FORMAT', 'png'),
+               'full_quality': current_app.config.get('SNAPSHOT_QUALITY'),
+               'full_max_bytes': current_app.config.get('SNAPSHOT_MAX_BYTES'),
+               'tiny_format': current_app.config.get('TINY_FORMAT', 'jpeg'),
+               'tiny_quality': current_app.config.get('TINY_QUALITY'),
+               'tiny_max_bytes': current_app.config.get('TINY_MAX_BYTES'),
+               'dedup_distance': current_app.config.get('SNAPSHOT_DEDUP_DISTANCE', 0),
+               'target_fps': current_app.config.get('SNAPSHOT_TARGET_FPS',
+                                                    FrameClassifier.TARGET_FPS) }
+    frame_ids = count()
+    frame_counts = { key: count_frames(episode)
+                     for key, episode in episodes.items() }
+    telemetry = IngestTelemetry(
+        sum(frame_counts.values()), len(episodes),
+        log_path=log_path, progress=progress,
+        shard=shard, workers=POPULATE_WORKERS, **config)
+    app = current_app._get_current_object()
+    def fill(key):
+        cursor = db.cursor()
+        episode = episodes[key]
+        stats = telemetry.episode(episode.slug, frame_counts[key])
+        with profiling.ingest_hooks(app, 'ingest;%s' % episode.slug):
+            saved, frames = populate_episode(episode, key, cursor, frame_ids,
+                                             stats=stats, **config)
+            with stats.stage('subtitles'):
+                populate_subtitles(episode, key, cursor)
+        telemetry.finish(stats, '%s - %d/%d frames (%.1f%%) saved, '
+                         '%d duplicates (%.1f MB) shared'
+                         % (episode.name, saved, frames,
+                            saved/frames*100.0 if frames > 0 else 0.0,
+                            stats.deduped, stats.bytes_saved/1e6))
+    try:
+        with ThreadPoolExecutor(max_workers=POPULATE_WORKERS) as executor:
+            for _ in executor.map(fill, episodes.keys()):
+                pass
+    finally:
+        telemetry.close()
+    db.commit()
+
+
+def count_frames(episode):
+    vidcap = cv2.VideoCapture(str(episode.video_path))
+    count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+    vidcap.release()
+    return count
+
+
+def populate_episode(episode, key, cur, frame_ids, full_vres=720, tiny_vres=100,
+                     full_format='png', full_quality=None, full_max_bytes=None,
+                     tiny_format='jpeg', tiny_quality=None, tiny_max_bytes=None,
+                     dedup_distance=0, target_fps=None, stats=None):
+    if stats is None:
+        stats = EpisodeStats(episode.slug, 0)
+
+    # Locate and save significant frames.
+    vidcap = cv2.VideoCapture(str(episode.video_path))
+    ms = 0
+    classifier = FrameClassifier(
+        target_fps=target_fps or FrameClassifier.TARGET_FPS)
+    dedup = FrameDeduplicator(dedup_distance)
+    with stats.stage('decode'):
+        success, image = vidcap.read()
+    while success:
+        ms = round(vidcap.get(cv2.CAP_PROP_POS_MSEC))
+        with stats.stage('classify'):
+            keep = classifier.classify(image, ms)
+        if keep:
+            stats.saved += 1
+
+            with stats.stage('resize'):
+                tiny_scale = tiny_vres/image.shape[0]
+                tiny_image = Image.fromarray(cv2.cvtColor(cv2.resize(
+                    image,
+                    (round(image.shape[1]*tiny_scale), round(image.shape[0]*tiny_scale)),
+                    interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB))
+            with stats.stage('hash'):
+                phash = images.dhash(tiny_image)
+                duplicate = dedup.find(phash, tiny_image)
+
+            if duplicate is None:
+                with stats.stage('resize'):
+                    big_scale = full_vres/image.shape[0]
+                    big_image = Image.fromarray(cv2.cvtColor(cv2.resize(
+                        image,
+                        (round(image.shape[1]*big_scale), round(image.shape[0]*big_scale)),
+                        interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB))
+                with stats.stage('encode'):
+                    big_data = images.encode(
+                        big_image, full_format,
+                        quality=full_quality, max_bytes=full_max_bytes)
+                    tiny_data = images.encode(
+                        tiny_image, tiny_format,
+                        quality=tiny_quality, max_bytes=tiny_max_bytes)
+                frame_id = next(frame_ids)
+                frame_size = len(big_data) + len(tiny_data)
+                with stats.stage('insert'):
+                    cur.execute(
+                        'INSERT INTO frame (id, episode_id, phash, image, format) '
+                        '       VALUES (:id, :episode_id, :phash, :image, :format)',
+                        { 'id': frame_id, 'episode_id': key, 'phash': phash,
+                          'image': sqlite3.Binary(big_data), 'format': full_format })
+                    cur.execute(
+                        'INSERT INTO frame_tiny (id, image, format) '
+                        '       VALUES (:id, :image, :format)',
+                        { 'id': frame_id,
+                          'image': sqlite3.Binary(tiny_data), 'format': tiny_format })
+                    cur.executemany(
+                        'INSERT INTO frame_hash (part, chunk, frame_id) '
+                        '       VALUES (:part, :chunk, :frame_id)',
+                        [{ 'part': part, 'chunk': chunk, 'frame_id': frame_id }
+                         for part, chunk in enumerate(images.hash_chunks(phash))])
+                dedup.add(phash, tiny_image, (frame_id, frame_size))
+                stats.bytes_written += frame_size
+            else:
+                frame_id, frame_size = duplicate
+                stats.deduped += 1
+                stats.bytes_saved += frame_size
+
+            with stats.stage('insert'):
+                cur.execute(
+                    'INSERT INTO snapshot (episode_id, ms, frame_id) '
+                    '       VALUES (:episode_id, :ms, :frame_id)',
+                    { 'episode_id': key, 'ms': ms, 'frame_id': frame_id })
+        stats.frames += 1
+        with stats.stage('decode'):
+            success, image = vidcap.read()
+
+    # Set the episode's duration.
+    cur.execute('UPDATE episode SET duration=:ms WHERE id=:id',
+                { 'id': key, 'ms': ms })
+
+    # Set the episode's preview frame.
+    cur.execute(
+        '  SELECT ms FROM snapshot '
+        '   WHERE episode_id=:episode_id '
+        'ORDER BY ABS(ms-:target) ASC LIMIT 1',
+        { 'episode_id': key, 'target': round(ms/2) })
+    res = cur.fetchone()
+    if res is not None:
+        cur.execute(
+            'UPDATE episode SET snapshot_ms=:snapshot_ms WHERE id=:id',
+            { 'id': key, 'snapshot_ms': res['ms'] })
+
+    return stats.saved, stats.frames
+
+
+class FrameClassifier(object):
+
+    TRANS_THRESHOLD = 90.0
+    TARGET_FPS = 5.0
+
+    def __init__(self, target_fps=TARGET_FPS):
+        self._last = self._saved = None
+        self._target_fps = target_fps
+
+    def classify(self, image, ms):
+        # - Save all hard transitions (color difference > TRANS_THRESHOLD).
+        # - Save at least 3 images per second, but only if there isn't a long
+        #   period of duplicate frames.
+        if self._last is None:
+            self._last = (image, ms)
+            save = True
+        else:
+            last_image, last_ms = self._last
+            saved_image, saved_ms = self._saved
+
+            last_color = numpy.average(last_image, axis=(0, 1))
+            this_color = numpy.average(image, axis=(0, 1))
+            color_diff = numpy.sum(abs(last_color - this_color))
+            if color_diff > FrameClassifier.TRANS_THRESHOLD:
+                #cv2.imwrite('classify_last.png', last_image)
+                #cv2.imwrite('classify_next.png', image)
+                #input('transition detected at %d' % ms)
+                save = True
+            elif (ms - saved_ms >= 1000/self._target_fps
+                  and color_diff > 0.1):
+                save = True
+            else:
+                save = False
+        self._last = (image, ms)
+        if save:
+            self._saved = (image, ms)
+        return save
+
+
+class FrameDeduplicator(object):
+
+    WINDOW = 64
+    EXACT_LIMIT = 1024
+    # Largest difference in any pixel of the grayscale tiny images for two
+    # frames to count as the same picture; this only absorbs decoder noise.
+    PIXEL_TOLERANCE = 8
+
+    def __init__(self, max_distance):
+        # Exact hash matches are looked up across the episode, up to
+        # EXACT_LIMIT hashes; near matches only among the most recently
+        # stored frames, which is where repeats of a static shot turn up.
+        # A hash only says two frames are composed alike, so every match
+        # is checked against the tiny image before the frame is shared.
+        self._max_distance = max_distance
+        self._exact = OrderedDict()
+        self._recent = deque(maxlen=FrameDeduplicator.WINDOW)
+
+    def find(self, phash, tiny_image):
+        if self._max_distance is None:
+            return None
+        pixels = tiny_image.convert('L')
+        candidate = self._exact.get(phash)
+        if candidate is not None and self._same(pixels, candidate[0]):
+            return candidate[1]
+        for other, other_pixels, match in reversed(self._recent):
+            if (images.hamming(phash, other) <= self._max_distance
+                    and self._same(pixels, other_pixels)):
+                return match
+        return None
+
+    def add(self, phash, tiny_image, frame):
+        pixels = tiny_image.convert('L')
+        if phash not in self._exact:
+            self._exact[phash] = (pixels, frame)
+            if len(self._exact) > FrameDeduplicator.EXACT_LIMIT:
+                self._exact.popitem(last=False)
+        self._recent.append((phash, pixels, frame))
+
+    @staticmethod
+    def _same(pixels, other):
+        return (images.pixel_difference(pixels, other)
+                <= FrameDeduplicator.PIXEL_TOLERANCE)
+
+
+def populate_subtitles(episode, key, cur):
+    cur.execute('SELECT season_id FROM episode WHERE id=:episode_id',
+                { 'episode_id': key })
+    season_key = cur.fetchone()['season_id']
+    for sub in episode.read_subtitles():
+        start_ms = sub.start.total_seconds()*1000
+        end_ms = sub.end.total_seconds()*1000
+        cur.execute(
+            'SELECT ms FROM snapshot '
+            '       WHERE episode_id=:episode_id '
+            '             AND ms>=:start_ms AND ms<=:end_ms '
+            'ORDER BY ms',
+            { 'episode_id': key, 'start_ms': start_ms, 'end_ms': end_ms })
+        snapshot_ms = next(map(lambda row: row['ms'], cur.fetchall()), None)
+        cur.execute(
+            'INSERT INTO subtitle (episode_id, idx, content, '
+            '                      start_ms, end_ms, snapshot_ms) '
+            '       VALUES (:episode_id, :idx, :content, '
+            '               :start_ms, :end_ms, :snapshot_ms)',
+            { 'episode_id': key, 'content': sub.content, 'idx': sub.index,
+              'start_ms': start_ms, 'end_ms': end_ms, 'snapshot_ms': snapshot_ms })
+        if snapshot_ms is not None:
+            cur.execute(
+                'INSERT INTO subtitle_search (episode_id, snapshot_ms, '
+                '                             content, facets) '
+                '       VALUES (:episode_id, :snapshot_ms, :content, :facets)',
+                { 'episode_id': key, 'snapshot_ms': snapshot_ms,
+                  'content': strip_html(sub.content),
+                  'facets': facet_tokens(season_key, key, snapshot_ms) })
@@ -7,7 +7,7 @@ from flask.cli import with_appcontext
 from srt import parse as parse_srt
 
 import knowledgeseeker.database as database
-import knowledgeseeker.ffmpeg as ff
+import knowledgeseeker.images as images
 
 
 class LoadError(Exception):
@@ -15,36 +15,49 @@ class LoadError(Exception):
 
 
 class Season(object):
-    def __init__(self, slug, name=None, episodes=[], icon_path=None):
+    __slots__ = ('slug', 'name', 'episodes', 'icon_path')
+
+    def __init__(self, slug, name=None, episodes=None, icon_path=None):
         self.slug = slug
         self.name = name
-        self.episodes = episodes
-        if icon_path is not None:
-            with open(icon_path, 'rb') as f:
-                self.icon = f.read()
-        else:
-            self.icon = None
+        self.episodes = episodes if episodes is not None else []
+        self.icon_path = icon_path
+
+    def read_icon(self):
+        if self.icon_path is None:
+            return None
+        with open(self.icon_path, 'rb') as f:
+            return f.read()
 
 
 class Episode(object):
+    __slots__ = ('slug', 'name', 'video_path', 'subtitles_path')
+
     def __init__(self, slug, video_path, subtitles_path=None, name=None):
         self.slug = slug
         self.name = name
         self.video_path = video_path
         self.subtitles_path = subtitles_path
-        if subtitles_path is None:
-            self.subtitles = []
-        else:
-            with open(subtitles_path) as f:
-                self.subtitles = list(parse_srt(f.read()))
-                self.subtitles.sort(key=lambda s: s.index)
+
+    def read_subtitles(self):
+        # Parsed on demand (by the ingest worker for this episode) so that
+        # subtitles are not held in memory for the whole run.
+        if self.subtitles_path is None:
+            return []
+        with open(self.subtitles_path) as f:
+            subtitles = list(parse_srt(f.read()))
+        subtitles.sort(key=lambda s: s.index)
+        return subtitles
 
 
 def load_library_file(library_path):
     with open(library_path, 'rt') as f:
         js_data = json.load(f)
-    return [read_season_json(season_data, relative_to=library_path.parent)
-            for season_data in js_data]
+    try:
+        return [read_season_json(season_data, relative_to=library_path.parent)
+                for season_data in js_data]
+    except KeyError as e:
+        raise LoadError('%s: missing key %s' % (library_path, e))
 
 
 def read_season_json(season_data, relative_to=Path('.')):
@@ -55,10 +68,8 @@ def read_season_json(season_data, relative_to=Path('.')):
     if icon is not None:
         icon = relative_to/Path(icon)
 
-    episodes = season_data.get('episodes', [])
-    if episodes != []:
-        episodes = [read_episode_json(episode_data, relative_to=relative_to)
-                    for episode_data in season_data['episodes']]
+    episodes = [read_episode_json(episode_data, relative_to=relative_to)
+                for episode_data in season_data.get('episodes', [])]
 
     return Season(slug, name=name, episodes=episodes, icon_path=icon)
 
@@ -73,19 +84,90 @@ def read_episode_json(episode_data, relative_to=Path('.')):
     return Episode(slug, video_path, subtitles_path=subtitles_path, name=name)
 
 
+def validate_library(library_data):
+    errors = []
+    season_slugs = set()
+    for season in library_data:
+        if season.slug in season_slugs:
+            errors.append('duplicate season slug: %s' % season.slug)
+        season_slugs.add(season.slug)
+        if season.icon_path is not None and not season.icon_path.is_file():
+            errors.append('%s: missing icon: %s' % (season.slug, season.icon_path))
+
+        episode_slugs = set()
+        for episode in season.episodes:
+            where = '%s/%s' % (season.slug, episode.slug)
+            if episode.slug in episode_slugs:
+                errors.append('duplicate episode slug: %s' % where)
+            episode_slugs.add(episode.slug)
+            if not episode.video_path.is_file():
+                errors.append('%s: missing video: %s' % (where, episode.video_path))
+            if (episode.subtitles_path is not None
+                    and not episode.subtitles_path.is_file()):
+                errors.append('%s: missing subtitles: %s'
+                              % (where, episode.subtitles_path))
+    if errors:
+        raise LoadError('invalid library:\n  %s' % '\n  '.join(errors))
+
+
 def init_app(app):
     app.cli.add_command(read_library_command)
 
 
 @click.command('read-library')
+@click.option('--library', 'names', multiple=True,
+              help='Only read the named library (repeatable).')
+@click.option('--log', 'log_path', type=click.Path(dir_okay=False),
+              help='Append machine-readable progress events (JSON lines).')
+@click.option('--progress/--no-progress', default=True,
+              help='Show a live progress line on a terminal.')
+@click.option('--captions/--no-captions', default=None,
+              help='Pre-render captioned snapshots for every subtitle line '
+                   '(default: PRERENDER_CAPTIONS).')
 @with_appcontext
-def read_library_command():
-    database.remove()
-    db = database.get_db()
+def read_library_command(names, log_path, progress, captions):
+    shards = database.shard_names()
+    for name in names:
+        if name not in shards:
+            raise click.BadParameter('unknown library: %s' % name,
+                                     param_hint='--library')
+    for shard in (names or shards):
+        if shard is not None:
+            print('Reading library %s' % shard)
+        read_library(shard, log_path=log_path, progress=progress,
+                     captions=captions)
+
+
+def read_library(shard=None, log_path=None, progress=True, captions=None):
+    # Validate before touching the existing database.
+    try:
+        library_data = load_library_file(Path(database.library_path(shard)))
+        validate_library(library_data)
+    except LoadError as e:
+        raise click.ClickException(str(e))
+    available = images.available_formats()
+    for key in ['SNAPSHOT_FORMAT', 'TINY_FORMAT']:
+        fmt = current_app.config.get(key)
+        if fmt is not None and fmt not in available:
+            raise click.ClickException(
+                '%s: %s is not supported by this Pillow build (have %s)'
+                % (key, fmt, ', '.join(available)))
+
+    database.remove(shard)
+    database.shard_dir(shard).mkdir(parents=True, exist_ok=True)
+    db = database.connect(shard)
     with current_app.open_resource('schema.sql', mode='r') as f:
         db.cursor().executescript(f.read())
     db.commit()
+    db.close()
+
+    import knowledgeseeker.ingest as ingest
+    ingest.populate(library_data, shard=shard, log_path=log_path,
+                    progress=progress)
 
-    library_data = load_library_file(Path(current_app.config.get('LIBRARY')))
-    database.populate(library_data)
+    if captions is None:
+        captions = current_app.config.get('PRERENDER_CAPTIONS', False)
+    if captions:
+        from knowledgeseeker.captions import render_captions
+        render_captions(shard)
 
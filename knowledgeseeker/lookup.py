@@ -0,0 +1,91 @@
+from itertools import combinations
+
+import flask
+from PIL import Image
+
+import knowledgeseeker.images as images
+from knowledgeseeker.database import get_db
+
+
+bp = flask.Blueprint('lookup', __name__)
+
+MAX_DISTANCE = 8
+N_LOOKUP_RESULTS = 10
+
+
+@bp.route('/lookup', methods=['POST'])
+def lookup():
+    upload = flask.request.files.get('image')
+    if upload is None:
+        flask.abort(400, 'no image uploaded')
+    try:
+        phash = images.dhash(images.decode(upload.read()))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        flask.abort(400, 'unreadable image')
+
+    max_distance = flask.current_app.config.get('LOOKUP_MAX_DISTANCE',
+                                                MAX_DISTANCE)
+    cur = get_db().cursor()
+    matches = find_frames(cur, phash, max_distance, N_LOOKUP_RESULTS)
+
+    results = []
+    for frame_id, distance in matches:
+        cur.execute(
+            '    SELECT season.slug AS season, episode.slug AS episode, '
+            '           MIN(snapshot.ms) AS ms '
+            '      FROM snapshot '
+            'INNER JOIN episode ON episode.id = snapshot.episode_id '
+            'INNER JOIN season ON season.id = episode.season_id '
+            '     WHERE snapshot.frame_id=:frame_id',
+            { 'frame_id': frame_id })
+        res = cur.fetchone()
+        if res['ms'] is None:
+            continue
+        slug_kwargs = { 'season': res['season'], 'episode': res['episode'],
+                        'ms': res['ms'] }
+        results.append({
+            'season': res['season'],
+            'episode': res['episode'],
+            'ms': res['ms'],
+            'distance': distance,
+            'url': flask.url_for('webui.browse_moment', **slug_kwargs),
+            'image': flask.url_for('clips.snapshot_tiny', **slug_kwargs) })
+    return flask.jsonify(results=results)
+
+
+def find_frames(cur, phash, max_distance, n_results):
+    # Multi-index hashing: if two hashes are within max_distance bits, then by
+    # the pigeonhole principle at least one of their HASH_PARTS chunks is
+    # within max_distance//HASH_PARTS bits. Look up every such chunk value in
+    # the frame_hash index, then verify the full distance of each candidate.
+    radius = max_distance//images.HASH_PARTS
+    candidates = set()
+    for part, chunk in enumerate(images.hash_chunks(phash)):
+        for value in chunk_neighbors(chunk, radius):
+            cur.execute(
+                'SELECT frame_id FROM frame_hash WHERE part=:part AND chunk=:chunk',
+                { 'part': part, 'chunk': value })
+            candidates.update(row['frame_id'] for row in cur.fetchall())
+
+    matches = []
+    candidates = list(candidates)
+    for i in range(0, len(candidates), 500):
+        batch = candidates[i:i + 500]
+        cur.execute('SELECT id, phash FROM frame WHERE id IN (%s)'
+                    % ','.join('?'*len(batch)), batch)
+        for row in cur.fetchall():
+            distance = images.hamming(phash, row['phash'])
+            if distance <= max_distance:
+                matches.append((row['id'], distance))
+    matches.sort(key=lambda match: match[1])
+    return matches[:n_results]
+
+
+def chunk_neighbors(chunk, radius):
+    yield chunk
+    for r in range(1, radius + 1):
+        for bits in combinations(range(images.CHUNK_BITS), r):
+            value = chunk
+            for bit in bits:
+                value ^= 1 << bit
+            yield value
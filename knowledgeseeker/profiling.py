@@ -0,0 +1,257 @@
+import atexit
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import flask
+
+
+PROFILE_DIR = 'profiles'
+SAMPLE_INTERVAL = 0.01
+FLUSH_SECS = 60
+
+_lock = threading.Lock()
+_sampler = None
+# Only one cProfile profiler can be active at once since Python 3.12.
+_capture_lock = threading.Lock()
+
+
+class Sampler(object):
+    # Samples the stacks of tracked threads from a background thread and
+    # counts them by label, written out in the folded format that
+    # flamegraph.pl and speedscope read: "label;outer;...;inner count".
+    __slots__ = ('interval', 'path', '_labels', '_counts', '_lock', '_thread',
+                 '_stopped')
+
+    def __init__(self, path, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.path = path
+        self._labels = {}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampler',
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def add(self, label):
+        with self._lock:
+            self._labels[threading.get_ident()] = label
+
+    def discard(self):
+        with self._lock:
+            self._labels.pop(threading.get_ident(), None)
+
+    def _run(self):
+        flushed = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            # Folding allocates, so it happens outside the lock.
+            with self._lock:
+                labels = list(self._labels.items())
+            stacks = [fold(label, frames[ident]) for ident, label in labels
+                      if ident in frames]
+            with self._lock:
+                for stack in stacks:
+                    self._counts[stack] += 1
+            del frames
+            if time.monotonic() - flushed > FLUSH_SECS:
+                self.flush()
+                flushed = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            lines = ['%s %d\n' % (stack, n) for stack, n in self._counts.items()]
+        if not lines:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.writelines(sorted(lines))
+        os.replace(tmp_path, self.path)
+
+
+def fold(label, frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (short_path(code.co_filename), code.co_name))
+        frame = frame.f_back
+    names.append(label)
+    return ';'.join(reversed(names))
+
+
+def short_path(path):
+    return '/'.join(path.replace('\\', '/').split('/')[-2:])
+
+
+def profile_dir(app):
+    return Path(app.instance_path)/app.config.get('PROFILE_DIR', PROFILE_DIR)
+
+
+def get_sampler(app):
+    # One sampler per process, started by whatever needs it first.
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = Sampler(
+                profile_dir(app)/('samples-%d.folded' % os.getpid()),
+                interval=app.config.get('PROFILE_SAMPLE_INTERVAL',
+                                        SAMPLE_INTERVAL))
+            _sampler.start()
+        return _sampler
+
+
+class Profiling(object):
+    # The profiling configured for one request or episode: stack sampling,
+    # and a full cProfile capture kept if it took at least threshold, as a
+    # pstats file for snakeviz or pstats. It runs only between resume() and
+    # pause(), so nothing is held while a streamed response waits on its
+    # client. Captures don't overlap, since only one cProfile profiler can be
+    # active at once since Python 3.12; work done while another capture runs
+    # goes unprofiled.
+    __slots__ = ('app', 'label', 'sampler', 'threshold', '_profile',
+                 '_start', '_capturing', '_finished')
+
+    def __init__(self, app, label, sampler=None, threshold=None):
+        self.app = app
+        self.label = label
+        self.sampler = sampler
+        self.threshold = threshold
+        self._profile = cProfile.Profile() if threshold is not None else None
+        self._start = time.monotonic()
+        self._capturing = False
+        self._finished = False
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    def resume(self):
+        if self._finished:
+            return
+        if self.sampler is not None:
+            self.sampler.add(self.label)
+        if (self._profile is not None and not self._capturing
+                and _capture_lock.acquire(blocking=False)):
+            try:
+                self._profile.enable()
+                self._capturing = True
+            except ValueError:
+                # Some other profiler or debugger is already active.
+                _capture_lock.release()
+
+    def pause(self):
+        if self._capturing:
+            self._profile.disable()
+            self._capturing = False
+            _capture_lock.release()
+        if self.sampler is not None:
+            self.sampler.discard()
+
+    def finish(self):
+        if self._finished:
+            return
+        self.pause()
+        self._finished = True
+        elapsed = time.monotonic() - self._start
+        if (self._profile is not None
+                and elapsed >= self.threshold.total_seconds()
+                and self._profile.getstats()):
+            out_dir = profile_dir(self.app)/'slow'
+            out_dir.mkdir(parents=True, exist_ok=True)
+            self._profile.dump_stats(str(out_dir/('%s-%s-%dms.prof'
+                % (datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                   re.sub(r'[^\w.-]', '_', self.label), elapsed*1000))))
+
+
+class ProfiledBody(object):
+    # A streamed response body that profiles each chunk as it is generated,
+    # finishing once the body runs out or the server closes it.
+    __slots__ = ('_iterable', '_iterator', '_profiling')
+
+    def __init__(self, iterable, profiling):
+        self._iterable = iterable
+        self._iterator = iter(iterable)
+        self._profiling = profiling
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._profiling.resume()
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self._profiling.finish()
+            raise
+        finally:
+            self._profiling.pause()
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._profiling.finish()
+
+
+def hooks(app, label, sampling_key, slow_key):
+    # The profiling configured for label: stack sampling if sampling_key is
+    # set, and full capture of anything slower than slow_key.
+    sampler = get_sampler(app) if app.config.get(sampling_key, False) else None
+    return Profiling(app, label, sampler=sampler,
+                     threshold=app.config.get(slow_key))
+
+
+def ingest_hooks(app, label):
+    # Ingest runs on worker threads without an app context, hence the app.
+    return hooks(app, label, 'PROFILE_INGEST', 'PROFILE_SLOW_EPISODE')
+
+
+def init_app(app):
+    if (not app.config.get('PROFILE_SAMPLING', False)
+            and app.config.get('PROFILE_SLOW_REQUEST') is None):
+        return
+
+    @app.before_request
+    def start_profiling():
+        label = flask.request.endpoint or 'unmatched'
+        flask.g._profiling = hooks(app, label, 'PROFILE_SAMPLING',
+                                   'PROFILE_SLOW_REQUEST')
+        flask.g._profiling.resume()
+
+    @app.after_request
+    def profile_body(response):
+        # Streamed bodies are generated after the request is torn down, so
+        # their chunks are profiled as the server asks for them.
+        profiling = flask.g.get('_profiling')
+        if profiling is not None and response.is_streamed:
+            response.response = ProfiledBody(response.response, profiling)
+            flask.g._profiling_streamed = True
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exception):
+        profiling = flask.g.pop('_profiling', None)
+        if profiling is None:
+            return
+        profiling.pause()
+        if not flask.g.pop('_profiling_streamed', False):
+            profiling.finish()
@@ -17,21 +17,45 @@ CREATE TABLE episode (
     season_id      INTEGER NOT NULL,
                    FOREIGN KEY (season_id) REFERENCES season(id)
 );
+CREATE TABLE frame (
+    id         INTEGER PRIMARY KEY,
+    episode_id INTEGER NOT NULL,
+    phash      INTEGER NOT NULL,
+    image      BLOB    NOT NULL,
+    format     TEXT    NOT NULL,
+               FOREIGN KEY (episode_id) REFERENCES episode(id)
+);
+CREATE TABLE frame_hash (
+    part       INTEGER NOT NULL,
+    chunk      INTEGER NOT NULL,
+    frame_id   INTEGER NOT NULL,
+               PRIMARY KEY (part, chunk, frame_id)
+               FOREIGN KEY (frame_id) REFERENCES frame(id)
+) WITHOUT ROWID;
+CREATE TABLE frame_tiny (
+    id         INTEGER PRIMARY KEY,
+    image      BLOB    NOT NULL,
+    format     TEXT    NOT NULL,
+               FOREIGN KEY (id) REFERENCES frame(id)
+);
 CREATE TABLE snapshot (
     episode_id INTEGER NOT NULL,
     ms         INTEGER NOT NULL,
-    png        BLOB    NOT NULL,
+    frame_id   INTEGER NOT NULL,
                PRIMARY KEY (episode_id, ms)
                FOREIGN KEY (episode_id) REFERENCES episode(id)
+               FOREIGN KEY (frame_id) REFERENCES frame(id)
                CHECK(ms >= 0)
 );
-CREATE TABLE snapshot_tiny (
+CREATE INDEX snapshot_frame ON snapshot (frame_id);
+CREATE TABLE caption (
     episode_id INTEGER NOT NULL,
     ms         INTEGER NOT NULL,
-    jpeg       BLOB    NOT NULL,
-               PRIMARY KEY (episode_id, ms)
-               FOREIGN KEY (episode_id) REFERENCES episode(id)
-               CHECK(ms >= 0)
+    text_hash  BLOB    NOT NULL,
+    image      BLOB    NOT NULL,
+    format     TEXT    NOT NULL,
+               PRIMARY KEY (episode_id, ms, text_hash)
+               FOREIGN KEY (episode_id, ms) REFERENCES snapshot(episode_id, ms)
 );
 CREATE TABLE subtitle (
     episode_id  INTEGER NOT NULL,
@@ -47,6 +71,10 @@ CREATE TABLE subtitle (
                 CHECK(snapshot_ms >= start_ms)
                 CHECK(snapshot_ms <= end_ms)
 );
+CREATE INDEX subtitle_start ON subtitle (episode_id, start_ms, idx);
 CREATE VIRTUAL TABLE subtitle_search
-       USING fts5(episode_id UNINDEXED, snapshot_ms UNINDEXED, content,
+       USING fts5(episode_id UNINDEXED, snapshot_ms UNINDEXED, content, facets,
                   tokenize = 'porter ascii');
+-- Facet tokens only filter; rank by the subtitle text alone.
+INSERT INTO subtitle_search (subtitle_search, rank)
+       VALUES ('rank', 'bm25(0.0, 0.0, 1.0, 0.0)');
@@ -0,0 +1,94 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+
+from knowledgeseeker.database import connect, is_read, shard_names
+from knowledgeseeker.webui import (clean_query, count_facets, parse_filters,
+                                   search_subtitles, N_SEARCH_RESULTS)
+
+
+bp = flask.Blueprint('shards', __name__)
+
+
+@bp.route('/')
+def index():
+    # Libraries that haven't been read yet are listed without seasons.
+    libraries = []
+    for shard in shard_names():
+        seasons = None
+        if is_read(shard):
+            db = connect(shard)
+            try:
+                cur = db.cursor()
+                cur.execute('SELECT slug, name FROM season')
+                seasons = cur.fetchall()
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                db.close()
+        libraries.append({ 'shard': shard, 'seasons': seasons })
+    return flask.render_template('libraries.html', libraries=libraries)
+
+
+@bp.route('/about')
+def about():
+    # Without this, /about would redirect to /about/ and be taken for a
+    # library's index.
+    return flask.render_template('about.html')
+
+
+@bp.route('/search')
+def search():
+    query = clean_query(flask.request.args.get('q'))
+    if query == '':
+        return flask.render_template('search.html', query='')
+
+    # Each shard gets its own connection, since sqlite3 connections cannot be
+    # shared between threads, and the workers need the app to find them.
+    filters = parse_filters(flask.request.args)
+    app = flask.current_app._get_current_object()
+    def search_shard(shard):
+        with app.app_context():
+            db = connect(shard)
+            try:
+                return (search_subtitles(db, query, N_SEARCH_RESULTS,
+                                         shard=shard, filters=filters),
+                        count_facets(db, query, shard=shard, filters=filters))
+            except sqlite3.OperationalError:
+                # Not read yet, or still being read.
+                return [], []
+            finally:
+                db.close()
+    shards = [shard for shard in shard_names() if is_read(shard)]
+    results = []
+    facets = []
+    with ThreadPoolExecutor(max_workers=max(1, len(shards))) as executor:
+        for shard_results, shard_facets in executor.map(search_shard, shards):
+            results += shard_results
+            facets += shard_facets
+    results.sort(key=lambda result: result['rank'])
+    results = results[:N_SEARCH_RESULTS]
+    return flask.render_template('search.html', query=query, results=results,
+                                 n_results=len(results), facets=facets,
+                                 filters=filters)
+
+
+def init_app(app):
+    @app.url_value_preprocessor
+    def pull_shard(endpoint, values):
+        if values is not None and 'shard' in values:
+            shard = values.pop('shard')
+            if shard not in app.config['LIBRARIES']:
+                flask.abort(404, 'library not found')
+            if not is_read(shard):
+                flask.abort(404, 'library not read')
+            flask.g.shard = shard
+
+    @app.url_defaults
+    def add_shard(endpoint, values):
+        if ('shard' not in values and flask.g.get('shard') is not None
+                and app.url_map.is_endpoint_expecting(endpoint, 'shard')):
+            values['shard'] = flask.g.shard
+
+    app.register_blueprint(bp)
@@ -0,0 +1,98 @@
+Episode = {
+        loader: null,
+        table: null,
+
+        loading: false,
+        startMs: null,
+        afterIdx: null,
+
+        /* start fetching when the loader is this close to the viewport */
+        margin: 1000
+};
+
+Episode.init = function() {
+        Episode.loader = $("#subtitle-loader");
+        Episode.table = $("#subtitles");
+        Episode.startMs = Episode.loader.data("start-ms");
+        Episode.afterIdx = Episode.loader.data("after-idx");
+
+        $(window).on("scroll resize", Episode.check);
+        Episode.check();
+};
+
+Episode.check = function() {
+        if (Episode.loading || Episode.loader === null)
+                return;
+        var bottom = $(window).scrollTop() + $(window).height();
+        if (Episode.loader.offset().top - bottom < Episode.margin)
+                Episode.loadWindow();
+};
+
+Episode.loadWindow = function() {
+        Episode.loading = true;
+        $.getJSON(Episode.loader.data("url"),
+                  { start_ms: Episode.startMs,
+                    after_idx: Episode.afterIdx,
+                    limit: Episode.loader.data("limit") })
+                .done(function(data) {
+                        $.each(data.subtitles, function(i, subtitle) {
+                                Episode.table.append(Episode.makeRow(subtitle));
+                                Episode.startMs = subtitle.start_ms;
+                                Episode.afterIdx = subtitle.idx;
+                        });
+                        Episode.loading = false;
+                        if (data.more) {
+                                Episode.check();
+                        } else {
+                                Episode.loader.remove();
+                                Episode.loader = null;
+                        }
+                })
+                .fail(function() {
+                        /* fall back to the complete page */
+                        window.location.href = Episode.loader.data("all-url");
+                });
+};
+
+Episode.makeRow = function(subtitle) {
+        var row = $("<tr>");
+        row.attr("class", "subtitle");
+
+        var text = $("<td>");
+        text.attr("class", "subtitle-text");
+        if (subtitle.url === undefined) {
+                text.html(subtitle.content);
+                row.append($("<td>"));
+                row.append(text);
+                return row;
+        }
+
+        var image = $("<img>");
+        image.attr({ "class": "image",
+                     src: subtitle.image,
+                     alt: "" });
+
+        var timecode = $("<span>");
+        timecode.attr("class", "timecode subtitle-range");
+        if (subtitle.start === subtitle.end)
+                timecode.text(subtitle.start);
+        else
+                timecode.text(subtitle.start + " - " + subtitle.end);
+
+        var wrap = $("<a>");
+        wrap.attr({ "class": "image-timecode-wrap",
+                    href: subtitle.url });
+        wrap.append(image);
+        wrap.append(timecode);
+
+        var link = $("<a>");
+        link.attr("href", subtitle.url);
+        link.html(subtitle.content);
+        text.append(link);
+
+        row.append($("<td>").append(wrap));
+        row.append(text);
+        return row;
+};
+
+Episode.init();
@@ -102,6 +102,7 @@ Moment.displayMedia = function(blob) {
                 Moment.displayScreen.append(imageWrap);
                 break;
         case "video/webm":
+        case "video/mp4":
                 video = $("<video>");
                 video.attr({ src: Moment.currentUrl,
                              controls: true,
@@ -138,6 +139,9 @@ Moment.displayMedia = function(blob) {
         case "video/webm":
                 filename = "animation.webm";
                 break;
+        case "video/mp4":
+                filename = "clip.mp4";
+                break;
         default:
                 break;
         }
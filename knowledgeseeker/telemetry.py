@@ -0,0 +1,169 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from knowledgeseeker.utils import strftimecode
+
+
+PROGRESS_INTERVAL = 1.0
+
+
+class EpisodeStats(object):
+    __slots__ = ('label', 'worker', 'total_frames', 'frames', 'saved',
+                 'deduped', 'bytes_written', 'bytes_saved', 'stages',
+                 'started', 'finished')
+
+    def __init__(self, label, total_frames):
+        self.label = label
+        self.worker = threading.current_thread().name
+        self.total_frames = total_frames
+        self.frames = self.saved = self.deduped = 0
+        self.bytes_written = self.bytes_saved = 0
+        self.stages = defaultdict(float)
+        self.started = time.monotonic()
+        self.finished = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def fps(self):
+        elapsed = self.elapsed()
+        return self.frames/elapsed if elapsed > 0 else 0.0
+
+    def to_json(self):
+        return { 'episode': self.label,
+                 'worker': self.worker,
+                 'frames': self.frames,
+                 'total_frames': self.total_frames,
+                 'saved': self.saved,
+                 'deduped': self.deduped,
+                 'bytes_written': self.bytes_written,
+                 'bytes_saved': self.bytes_saved,
+                 'seconds': round(self.elapsed(), 3),
+                 'fps': round(self.fps(), 2),
+                 'stages': { name: round(secs, 3)
+                             for name, secs in self.stages.items() } }
+
+
+class IngestTelemetry(object):
+    """Tracks ingest progress, draws a live status line and writes a JSON log.
+
+    The log has one JSON object per line: a 'start' event, an 'episode' event
+    per finished episode and a closing 'summary' event.
+    """
+
+    def __init__(self, total_frames, n_episodes, log_path=None, progress=True,
+                 **run_info):
+        self.total_frames = total_frames
+        self.n_episodes = n_episodes
+        self._lock = threading.Lock()
+        self._active = []
+        self._finished = []
+        self._started = time.monotonic()
+        self._log = open(log_path, 'a') if log_path is not None else None
+        self._live = progress and sys.stderr.isatty()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log_event('start', total_frames=total_frames,
+                        episodes=n_episodes, **run_info)
+        if self._live:
+            self._thread = threading.Thread(target=self._draw_loop, daemon=True)
+            self._thread.start()
+
+    def episode(self, label, total_frames):
+        stats = EpisodeStats(label, total_frames)
+        with self._lock:
+            self._active.append(stats)
+        return stats
+
+    def finish(self, stats, message):
+        stats.finished = time.monotonic()
+        with self._lock:
+            self._active.remove(stats)
+            self._finished.append(stats)
+            self._clear_line()
+            print(' * %s' % message)
+        self._log_event('episode', **stats.to_json())
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            with self._lock:
+                self._clear_line()
+        stages = defaultdict(float)
+        for stats in self._finished:
+            for name, secs in stats.stages.items():
+                stages[name] += secs
+        elapsed = time.monotonic() - self._started
+        frames = sum(stats.frames for stats in self._finished)
+        self._log_event(
+            'summary',
+            frames=frames,
+            saved=sum(stats.saved for stats in self._finished),
+            deduped=sum(stats.deduped for stats in self._finished),
+            bytes_written=sum(stats.bytes_written for stats in self._finished),
+            bytes_saved=sum(stats.bytes_saved for stats in self._finished),
+            seconds=round(elapsed, 3),
+            fps=round(frames/elapsed, 2) if elapsed > 0 else 0.0,
+            stages={ name: round(secs, 3) for name, secs in stages.items() })
+        if self._log is not None:
+            self._log.close()
+
+    def frames_done(self):
+        with self._lock:
+            return sum(stats.frames for stats in self._finished + self._active)
+
+    def eta(self):
+        elapsed = time.monotonic() - self._started
+        done = self.frames_done()
+        if done == 0 or self.total_frames <= done:
+            return None
+        return timedelta(seconds=elapsed/done*(self.total_frames - done))
+
+    def status(self):
+        elapsed = time.monotonic() - self._started
+        done = self.frames_done()
+        eta = self.eta()
+        with self._lock:
+            workers = ' '.join('%s:%.0f' % (stats.label, stats.fps())
+                               for stats in self._active)
+            n_finished = len(self._finished)
+        return ('[%d/%d episodes] %d/%d frames, %.0f fps, ETA %s | %s'
+                % (n_finished, self.n_episodes, done, self.total_frames,
+                   done/elapsed if elapsed > 0 else 0.0,
+                   strftimecode(eta) if eta is not None else '?', workers))
+
+    def _draw_loop(self):
+        while not self._stop.wait(PROGRESS_INTERVAL):
+            line = self.status()
+            with self._lock:
+                sys.stderr.write('\r\x1b[K' + line)
+                sys.stderr.flush()
+
+    def _clear_line(self):
+        if self._live:
+            sys.stderr.write('\r\x1b[K')
+            sys.stderr.flush()
+
+    def _log_event(self, event, **kwargs):
+        if self._log is None:
+            return
+        record = { 'event': event, 'time': datetime.now().isoformat() }
+        record.update(kwargs)
+        with self._lock:
+            self._log.write(json.dumps(record) + '\n')
+            self._log.flush()
@@ -43,6 +43,16 @@ def set_expires(f):
     return decorator
 
 
+def stream_template(template_name, buffer_size=5, **context):
+    # Like render_template, but yields the page as it renders, so the first
+    # bytes go out before every row has been read from the database.
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(buffer_size)
+    return stream
+
+
 def strip_html(s):
     return re.sub(r'</?[^>]+>', '', s)
 
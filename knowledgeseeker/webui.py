@@ -1,12 +1,16 @@
 import re
 from datetime import timedelta
+from itertools import chain
 from urllib.parse import unquote
 
 import flask
 from base64 import b64encode
 
-from knowledgeseeker.database import get_db, match_episode, match_season
-from knowledgeseeker.utils import set_expires, strftimecode, strip_html
+from knowledgeseeker.database import (connect, get_db, match_episode,
+                                      match_season, EPISODE_FACET,
+                                      MINUTE_FACET, SEASON_FACET)
+from knowledgeseeker.utils import (set_expires, stream_template, strftimecode,
+                                   strip_html, strptimecode)
 
 
 bp = flask.Blueprint('webui', __name__)
@@ -15,6 +19,12 @@ NAV_STEPS = 3
 CLOSE_SUBTITLE_SECS = 3
 MAX_SEARCH_LENGTH = 80
 N_SEARCH_RESULTS = 50
+MAX_MINUTE_FACETS = 30
+MAX_MS = 2**62
+# Subtitles rendered with the episode page; the rest are fetched by script as
+# the reader scrolls.
+EPISODE_WINDOW = 100
+MAX_SUBTITLE_WINDOW = 500
 
 
 @bp.route('/')
@@ -97,20 +107,94 @@ def browse_episode(season_id, episode_id):
     targs['episode'] = res['slug']
     targs['episode_name'] = res['name']
 
-    # Retrieve all subtitles.
+    # Stream the first window of subtitles, or all of them for clients
+    # without script, straight from the cursor. The request's connection is
+    # closed before the response streams, so this one is kept until the end.
+    show_all = flask.request.args.get('all', '0') not in ('', '0')
+    db = connect(flask.g.get('shard'))
+    cur = db.cursor()
     cur.execute(
-        'SELECT start_ms, end_ms, snapshot_ms, content FROM subtitle '
-        ' WHERE episode_id=:episode_id ORDER BY start_ms',
-        { 'episode_id': episode_id })
-    res = cur.fetchall()
-    if len(res) == 0:
+        '  SELECT idx, start_ms, end_ms, snapshot_ms, content FROM subtitle '
+        '   WHERE episode_id=:episode_id '
+        'ORDER BY start_ms, idx LIMIT :limit',
+        { 'episode_id': episode_id,
+          'limit': -1 if show_all else EPISODE_WINDOW })
+    first = cur.fetchone()
+    if first is None:
+        db.close()
         flask.abort(404, 'no subtitles found')
-    targs['subtitles'] = res
+    targs['subtitles'] = chain([first], cur)
+    targs['show_all'] = show_all
+    targs['window'] = EPISODE_WINDOW
 
     def str_ms(ms):
         return strftimecode(timedelta(milliseconds=ms))
     targs['str_ms'] = str_ms
-    return flask.render_template('episode.html', **targs)
+    def generate():
+        try:
+            yield from stream_template('episode.html', **targs)
+        finally:
+            db.close()
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='text/html')
+
+
+@bp.route('/<season>/<episode>/subtitles')
+@match_episode
+def episode_subtitles(season_id, episode_id):
+    # Subtitles in start time order from start_ms, continuing after the
+    # subtitle numbered after_idx if given.
+    start_ms = flask.request.args.get('start_ms', 0, type=int)
+    after_idx = flask.request.args.get('after_idx', None, type=int)
+    limit = flask.request.args.get('limit', EPISODE_WINDOW, type=int)
+    if start_ms < 0 or limit <= 0:
+        flask.abort(400, 'bad window')
+    limit = min(limit, MAX_SUBTITLE_WINDOW)
+
+    cur = get_db().cursor()
+    cur.execute('SELECT slug FROM season WHERE id=:season_id',
+                { 'season_id': season_id })
+    season = cur.fetchone()['slug']
+    cur.execute('SELECT slug FROM episode WHERE id=:episode_id',
+                { 'episode_id': episode_id })
+    episode = cur.fetchone()['slug']
+    slug_kwargs = { 'season': season, 'episode': episode }
+
+    if after_idx is None:
+        cur.execute(
+            '  SELECT idx, start_ms, end_ms, snapshot_ms, content FROM subtitle '
+            '   WHERE episode_id=:episode_id AND start_ms>=:start_ms '
+            'ORDER BY start_ms, idx LIMIT :limit',
+            { 'episode_id': episode_id, 'start_ms': start_ms,
+              'limit': limit + 1 })
+    else:
+        cur.execute(
+            '  SELECT idx, start_ms, end_ms, snapshot_ms, content FROM subtitle '
+            '   WHERE episode_id=:episode_id '
+            '         AND (start_ms, idx)>(:start_ms, :after_idx) '
+            'ORDER BY start_ms, idx LIMIT :limit',
+            { 'episode_id': episode_id, 'start_ms': start_ms,
+              'after_idx': after_idx, 'limit': limit + 1 })
+    rows = cur.fetchall()
+
+    def str_ms(ms):
+        return strftimecode(timedelta(milliseconds=ms))
+    subtitles = []
+    for row in rows[:limit]:
+        subtitle = { 'idx': row['idx'],
+                     'start_ms': row['start_ms'],
+                     'end_ms': row['end_ms'],
+                     'snapshot_ms': row['snapshot_ms'],
+                     'content': row['content'],
+                     'start': str_ms(row['start_ms']),
+                     'end': str_ms(row['end_ms']) }
+        if row['snapshot_ms'] is not None:
+            subtitle['url'] = flask.url_for(
+                'webui.browse_moment', ms=row['snapshot_ms'], **slug_kwargs)
+            subtitle['image'] = flask.url_for(
+                'clips.snapshot_tiny', ms=row['snapshot_ms'], **slug_kwargs)
+        subtitles.append(subtitle)
+    return flask.jsonify(subtitles=subtitles, more=len(rows) > limit)
 
 
 @bp.route('/<season>/<episode>/<int:ms>/')
@@ -172,28 +256,172 @@ def browse_moment(season_id, episode_id, ms):
 
 @bp.route('/search')
 def search():
-    query = flask.request.args.get('q')
-    if query is None:
-        query = ''
-
-    query = unquote(query)
-    query = re.sub(r'[^a-zA-Z0-9 \']', '', query)
-    query = query[0:MAX_SEARCH_LENGTH]
+    query = clean_query(flask.request.args.get('q'))
     if query == '':
         return flask.render_template('search.html', query='')
 
-    cur = get_db().cursor()
+    filters = parse_filters(flask.request.args)
+    db = get_db()
+    shard = flask.g.get('shard')
+    results = search_subtitles(db, query, N_SEARCH_RESULTS, shard=shard,
+                               filters=filters)
+    facets = count_facets(db, query, shard=shard, filters=filters)
+    return flask.render_template('search.html', query=query, results=results,
+                                 n_results=len(results), facets=facets,
+                                 filters=filters)
+
+
+def clean_query(query):
+    if query is None:
+        return ''
+    query = unquote(query)
+    query = re.sub(r'[^a-zA-Z0-9 \']', '', query)
+    return query[0:MAX_SEARCH_LENGTH]
+
+
+def parse_filters(args):
+    # Seasons and episodes by slug, and a time range within the episode as
+    # timecodes, e.g. ?season=book1&from=5:00&to=10:00.
+    filters = { 'seasons': args.getlist('season'),
+                'episodes': args.getlist('episode'),
+                'from': args.get('from', ''),
+                'to': args.get('to', ''),
+                'from_ms': None,
+                'to_ms': None }
+    for name in ('from', 'to'):
+        if filters[name] != '':
+            try:
+                timecode = strptimecode(filters[name])
+            except ValueError:
+                flask.abort(400, 'bad time filter')
+            filters[name + '_ms'] = round(timecode.total_seconds()*1000)
+    return filters
+
+
+def search_subtitles(db, query, n_results, shard=None, filters=None):
+    cur = db.cursor()
+    match = search_match(cur, query, filters)
+    if match is None:
+        return []
+    from_ms, to_ms = time_bounds(filters)
     cur.execute('PRAGMA full_column_names = ON')
     cur.execute(
-        '    SELECT episode.slug, season.slug, search.snapshot_ms, search.content '
+        '    SELECT episode.slug, season.slug, search.snapshot_ms, search.content, '
+        '           search.rank '
         '           FROM season '
         'INNER JOIN episode ON episode.season_id = season.id '
-        'INNER JOIN (SELECT episode_id, snapshot_ms, content FROM subtitle_search '
-        '             WHERE content MATCH :query LIMIT :n_results) search '
-        '           ON search.episode_id = episode.id',
-        { 'query': ' '.join('"%s"' % term for term in query.split()),
-          'n_results': N_SEARCH_RESULTS })
-    results = cur.fetchall()
-    return flask.render_template('search.html', query=query, results=results,
-                                 n_results=len(results))
-
+        'INNER JOIN (SELECT episode_id, snapshot_ms, content, rank '
+        '              FROM subtitle_search '
+        '             WHERE subtitle_search MATCH :match '
+        '                   AND snapshot_ms>=:from_ms AND snapshot_ms<=:to_ms '
+        '          ORDER BY rank LIMIT :n_results) search '
+        '           ON search.episode_id = episode.id '
+        '  ORDER BY search.rank',
+        { 'match': match, 'from_ms': from_ms, 'to_ms': to_ms,
+          'n_results': n_results })
+    results = [{ 'shard': shard,
+                 'season': row['season.slug'],
+                 'episode': row['episode.slug'],
+                 'snapshot_ms': row['search.snapshot_ms'],
+                 'content': row['search.content'],
+                 'rank': row['search.rank'] }
+               for row in cur.fetchall()]
+    cur.execute('PRAGMA full_column_names = OFF')
+    return results
+
+
+def count_facets(db, query, shard=None, filters=None):
+    # Hits per season and episode for the text and time filters, leaving out
+    # the season and episode filters so the other choices still show.
+    if filters is not None:
+        filters = dict(filters, seasons=[], episodes=[])
+    cur = db.cursor()
+    match = search_match(cur, query, filters)
+    if match is None:
+        return []
+    from_ms, to_ms = time_bounds(filters)
+    cur.execute('PRAGMA full_column_names = ON')
+    cur.execute(
+        '    SELECT season.slug, season.name, episode.slug, episode.name, '
+        '           COUNT(*) AS hits '
+        '      FROM subtitle_search '
+        'INNER JOIN episode ON episode.id = subtitle_search.episode_id '
+        'INNER JOIN season ON season.id = episode.season_id '
+        '     WHERE subtitle_search MATCH :match '
+        '           AND subtitle_search.snapshot_ms>=:from_ms '
+        '           AND subtitle_search.snapshot_ms<=:to_ms '
+        '  GROUP BY episode.id '
+        '  ORDER BY season.id, episode.id',
+        { 'match': match, 'from_ms': from_ms, 'to_ms': to_ms })
+    facets = []
+    for row in cur.fetchall():
+        if len(facets) == 0 or facets[-1]['season'] != row['season.slug']:
+            facets.append({ 'shard': shard,
+                            'season': row['season.slug'],
+                            'name': row['season.name'],
+                            'hits': 0,
+                            'episodes': [] })
+        facets[-1]['hits'] += row['hits']
+        facets[-1]['episodes'].append({ 'episode': row['episode.slug'],
+                                        'name': row['episode.name'],
+                                        'hits': row['hits'] })
+    cur.execute('PRAGMA full_column_names = OFF')
+    return facets
+
+
+def search_match(cur, query, filters=None):
+    # Builds the full-text query, or returns None if the filters can't match
+    # anything. Terms only match the subtitle text; filters match the facet
+    # tokens written at ingest.
+    match = 'content : (%s)' % ' '.join('"%s"' % term for term in query.split())
+    if filters is None:
+        return match
+
+    season_ids = None
+    if filters['seasons']:
+        cur.execute('SELECT id FROM season WHERE slug IN (%s)'
+                    % ','.join('?'*len(filters['seasons'])), filters['seasons'])
+        season_ids = [row['id'] for row in cur.fetchall()]
+        if len(season_ids) == 0:
+            return None
+        match += ' AND facets : (%s)' % ' OR '.join(SEASON_FACET % season_id
+                                                    for season_id in season_ids)
+    if filters['episodes']:
+        sql = ('SELECT id FROM episode WHERE slug IN (%s)'
+               % ','.join('?'*len(filters['episodes'])))
+        params = list(filters['episodes'])
+        if season_ids is not None:
+            sql += ' AND season_id IN (%s)' % ','.join('?'*len(season_ids))
+            params += season_ids
+        cur.execute(sql, params)
+        episode_ids = [row['id'] for row in cur.fetchall()]
+        if len(episode_ids) == 0:
+            return None
+        match += ' AND facets : (%s)' % ' OR '.join(EPISODE_FACET % episode_id
+                                                    for episode_id in episode_ids)
+
+    # Narrow to the minutes the time range touches; the exact bounds are
+    # checked against snapshot_ms. Wide ranges aren't worth the tokens.
+    from_ms, to_ms = time_bounds(filters)
+    if to_ms < from_ms:
+        return None
+    first, last = from_ms//60000, to_ms//60000
+    if filters['to_ms'] is not None and last - first < MAX_MINUTE_FACETS:
+        match += ' AND facets : (%s)' % ' OR '.join(
+            MINUTE_FACET % minute for minute in range(first, last + 1))
+    return match
+
+
+def time_bounds(filters):
+    if filters is None:
+        return 0, MAX_MS
+    return (filters['from_ms'] if filters['from_ms'] is not None else 0,
+            filters['to_ms'] if filters['to_ms'] is not None else MAX_MS)
+
+
+@bp.app_context_processor
+def inject_home_endpoint():
+    if flask.current_app.config.get('LIBRARIES'):
+        return { 'home_endpoint': 'shards.index' }
+    else:
+        return { 'home_endpoint': 'webui.index' }
@@ -7,6 +7,12 @@ from pathlib import Path
 
 ## All episodes, their video files, and their subtitle files.
 LIBRARY = Path('library/atla.json')
+# To host more than one show, name each library file instead. Every library
+# gets its own database under shards/<name>/ and its pages under /<name>/.
+#LIBRARIES = {
+#    'atla': Path('library/atla.json'),
+#    'lok': Path('library/lok.json'),
+#}
 
 ## Jpeg snapshots and subtitling.
 JPEG_VRES = 720
@@ -15,6 +21,47 @@ JPEG_TINY_VRES = 100
 PIL_FONT = Path('library/Avatar The Last Airbender/knowledgeseeker/fonts/Herculanum.woff')
 PIL_FONT_SIZE = 60
 PIL_MAXWIDTH = 30
+# Render every subtitle line onto its snapshot during read-library, so the
+# "JPEG+Sub" links are served without drawing anything. Also available on
+# its own as `flask render-captions`.
+PRERENDER_CAPTIONS = False
+
+## Snapshot storage and serving formats: png, jpeg, webp, or avif (if Pillow
+## supports it). Compare them on your own library with `flask bench-codecs`.
+SNAPSHOT_FORMAT = 'png'
+SNAPSHOT_QUALITY = 90
+# Lower the quality of lossy formats until each image fits, if set.
+SNAPSHOT_MAX_BYTES = None
+TINY_FORMAT = 'jpeg'
+TINY_QUALITY = 75
+TINY_MAX_BYTES = None
+# Snapshots whose perceptual hashes differ by at most this many bits (of 64)
+# share one stored image, if their pixels match too. Hashes of different
+# pictures can be a bit or two apart, so raising this mostly costs time.
+# None stores every kept frame separately.
+SNAPSHOT_DEDUP_DISTANCE = 0
+# Formats sent for /pic, by preference; each is used only if the client's
+# Accept header lists it. Stored images in one of these are sent as-is.
+SERVE_FORMATS = ['webp', 'jpeg']
+SERVE_QUALITY = 85
+
+## On-demand snapshots: render frames that weren't kept during ingest with
+## ffmpeg when they're requested, caching them under the instance folder in the
+## format they were served in.
+ONDEMAND_SNAPSHOTS = False
+ONDEMAND_WORKERS = 2
+ONDEMAND_CACHE_BYTES = 1024*1024*1024
+# Renders for new frames queued at once, and seconds a request waits for one,
+# before /pic answers 503 instead of tying up a server thread.
+ONDEMAND_QUEUE = 8
+ONDEMAND_TIMEOUT = 10
+# With on-demand snapshots, ingest can keep fewer frames: the minimum interval
+# between kept frames without a hard transition is 1/SNAPSHOT_TARGET_FPS.
+SNAPSHOT_TARGET_FPS = 5.0
+
+## Reverse image lookup: the largest perceptual hash distance (of 64 bits) to
+## report as a match. Lookup cost grows quickly beyond 11.
+LOOKUP_MAX_DISTANCE = 8
 
 ## Paths to ffmpeg binaries.
 FFMPEG_PATH = 'ffmpeg'
@@ -25,6 +72,18 @@ GIF_VRES = 360
 WEBM_VRES = 480
 MAX_GIF_LENGTH = timedelta(seconds=10)
 MAX_WEBM_LENGTH = timedelta(seconds=15)
+# MP4 clips are cut from the video files without re-encoding, so they start
+# on the keyframe before the requested time. ?exact=1 re-encodes the frames
+# up to the next keyframe instead. Copying needs H.264 video; anything else
+# is re-encoded in full.
+MAX_MP4_LENGTH = timedelta(seconds=30)
+# Clip renders pick their resolution, VP9 speed and thread count from how
+# busy the server is, aiming to finish within RENDER_LATENCY_TARGET. Clients
+# can ask for ?tier=preview (fast, half resolution) or ?tier=final (full
+# quality regardless of load) instead. RENDER_SLOTS defaults to the number of
+# CPUs.
+RENDER_LATENCY_TARGET = timedelta(seconds=5)
+RENDER_SLOTS = None
 # Ffmpeg requires a path to the directory containing your desired font...
 FF_FONT_DIR = Path('library/Avatar The Last Airbender/knowledgeseeker/fonts/')
 # ...and its filename, without the extension.
@@ -33,3 +92,34 @@ FF_FONT_SIZE = 24
 
 ## Server options.
 HTTP_CACHE_EXPIRES = timedelta(days=7)
+# Admission control: every route has a cost in tokens (a snapshot costs 1, a
+# 10 second WebM with subtitles 60), and requests are refused with 429 once a
+# client, or all clients together, outspend their token bucket. Requests
+# costing at most ADMISSION_FREE_COST always go through, but rendering a
+# frame on demand or retrying a budgeted clip is always charged. Clients are
+# told apart by remote address, so behind a reverse proxy wrap the app in
+# werkzeug's ProxyFix. Buckets live in each worker's memory unless
+# ADMISSION_STATE names a file to share them through.
+ADMISSION_CONTROL = False
+ADMISSION_CLIENT_RATE = 1.0
+ADMISSION_CLIENT_BURST = 120
+ADMISSION_GLOBAL_RATE = 20.0
+ADMISSION_GLOBAL_BURST = 600
+ADMISSION_FREE_COST = 1
+#ADMISSION_STATE = Path('admission.db')
+
+## Profiling, written under PROFILE_DIR in the instance folder.
+# Sample the stacks of requests in flight every PROFILE_SAMPLE_INTERVAL
+# seconds into samples-<pid>.folded, one root per endpoint, for flamegraph.pl
+# or speedscope.
+PROFILE_SAMPLING = False
+PROFILE_SAMPLE_INTERVAL = 0.01
+# Profile requests in full with cProfile and keep the profiles of those
+# that take at least this long in slow/ (e.g. timedelta(seconds=1)). Only
+# one request is profiled at a time; this slows every profiled request down.
+PROFILE_SLOW_REQUEST = None
+# The same for read-library: sample every episode's ingest, and keep full
+# profiles of episodes that take at least PROFILE_SLOW_EPISODE.
+PROFILE_INGEST = False
+PROFILE_SLOW_EPISODE = None
+PROFILE_DIR = Path('profiles')
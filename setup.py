@@ -9,8 +9,14 @@ setup(
     install_requires=[
         'flask',
         'ffmpeg-python',
-        'opencv-python-headless',
         'Pillow',
         'srt'
     ],
+    extras_require={
+        # Only needed to read the library (flask read-library).
+        'ingest': [
+            'numpy',
+            'opencv-python-headless'
+        ]
+    },
 )